@@ -1,4 +1,13 @@
+import io
+import os
+import glob
+import shlex
+import time
 import click
+from collections import Counter
+from itertools import groupby
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ProcessPoolExecutor
 from . import lib
 logging = lib.logging
 
@@ -18,10 +27,15 @@ logging = lib.logging
 @click.option('--preset',
     help=('load a given preset. Where possible presets are merged '
         'with options otherwise options override presets'))
+@click.option('--ref-index/--no-ref-index',default=True,
+    help=('keep an index of the assets referenced by each database so only '
+        'the databases which use a changed asset are rewritten'))
 @click.pass_context
-def cli(ctx,loglevel,logfile,datadir,showpresets,preset,config,edit,mkconfig):
+def cli(ctx,loglevel,logfile,datadir,showpresets,preset,config,edit,mkconfig,
+        ref_index):
     """Commands for managing asset files in foundry worlds"""
     ctx.ensure_object(dict)
+    ctx.obj['REF_INDEX'] = ref_index
     if logfile:
         logging.basicConfig(filename=logfile, level=logging.DEBUG)
     if not loglevel.lower() == "quiet":
@@ -93,6 +107,32 @@ def cli(ctx,loglevel,logfile,datadir,showpresets,preset,config,edit,mkconfig):
     elif not ctx.invoked_subcommand:
         click.echo(ctx.get_help())
 
+def report_copies(manager):
+    """show how many bytes were copied and linked by manager"""
+    if manager.copy_stats.files:
+        click.echo(f"Copied files, {manager.copy_stats}")
+
+def write_plan(manager,plan_file):
+    """save the queued changes of manager for the apply command"""
+    plan = manager.plan()
+    lib.Path(plan_file).write_text(lib.json.dumps(plan,indent=2),
+                                   encoding='utf-8')
+    click.echo(f"Wrote a plan changing {len(plan['files'])} files to {plan_file}")
+
+def open_ref_index(ctx,manager,required=False):
+    """
+    give manager an up to date reference index of its project. When the
+    index is disabled and required is set a temporary index is used.
+    """
+    if ctx.obj.get('REF_INDEX'):
+        index_file = lib.Path(click.get_app_dir('foundryWorldTools')) / "refindex.sqlite"
+    elif required:
+        index_file = ":memory:"
+    else:
+        return
+    manager.ref_index = lib.FWTRefIndex(index_file,manager.project_dir)
+    manager.ref_index.refresh()
+
 @cli.command()
 @click.option('--ext',multiple=True,
     help='file extension filter. May be used multiple times.')
@@ -106,15 +146,57 @@ def cli(ctx,loglevel,logfile,datadir,showpresets,preset,config,edit,mkconfig):
     help='method for finding duplicates')
 @click.option('--exclude-dir',multiple=True,
     help="Directory name or path to exclude. May be used multiple times.")
-@click.argument('dir',type=click.Path(exists=True,file_okay=False))
+@click.option('--cache/--no-cache',default=True,
+    help='keep file hashes in a cache so unchanged files are not read again')
+@click.option('--jobs',type=click.IntRange(min=1),default=1,
+    help='number of files to hash or databases to rewrite at the same time')
+@click.option('--across',is_flag=True,default=False,
+    help=('find files with the same content in more than one project, keep '
+    'one copy in the store directory and update the databases of every '
+    'project. Implies --bycontent.'))
+@click.option('--store-dir',default="fwt-store",show_default=True,
+    help='store directory for --across, relative to the user data dir')
+@click.option('--hardlink',is_flag=True,default=False,
+    help=('with --across replace the copies with hard links to the '
+    'preferred file instead of using the store'))
+@click.option('--plan-out',type=click.Path(dir_okay=False),
+    help=('write the duplicates found and the database changes to a plan '
+    'file instead of changing anything. See the apply command.'))
+@click.argument('dirs',nargs=-1,required=True,metavar='DIR...',
+    type=click.Path(exists=True,file_okay=False))
 @click.pass_context
-def dedup(ctx,dir,ext,preferred,byname,bycontent,exclude_dir):
+def dedup(ctx,dirs,ext,preferred,byname,bycontent,exclude_dir,cache,jobs,
+          across,store_dir,hardlink,plan_out):
     """Scans for duplicate files, removes duplicates and updates fvtt's databases.
     
-    DIR should be a directory containing a world.json file"""
+    DIR should be a directory containing a world.json file. With --across
+    any number of world and module directories may be given."""
     logging.debug(f"dedup started with options {lib.json.dumps(ctx.params)}")
-    dir = lib.FWTPath(dir)
-    dup_manager = lib.FWTSetManager(dir)
+    if across:
+        projects = {}
+        for dir in dirs:
+            dir = lib.FWTPath(dir)
+            if dir.is_project:
+                projects.setdefault(dir.as_rpd(),dir.to_fpd())
+            else:
+                logging.warning(f"dedup: skipping {dir}, not a project")
+        if len(projects) < 2:
+            ctx.fail("--across requires at least two project directories")
+        if plan_out:
+            ctx.fail("--plan-out can't be used with --across")
+        dup_manager = lib.FWTStoreManager(list(projects.values()),store_dir)
+        dup_manager.hardlink = hardlink
+        bycontent = not byname
+        if not hardlink:
+            for project in dup_manager.projects:
+                open_ref_index(ctx,project)
+    elif len(dirs) > 1:
+        ctx.fail("more than one DIR requires --across")
+    elif hardlink:
+        ctx.fail("--hardlink requires --across")
+    else:
+        dup_manager = lib.FWTSetManager(lib.FWTPath(dirs[0]))
+        open_ref_index(ctx,dup_manager)
     preset = ctx.obj.get('PRESET',None)
     if preset:
         preferred += tuple(preset.get('preferred',[]))
@@ -129,17 +211,34 @@ def dedup(ctx,dir,ext,preferred,byname,bycontent,exclude_dir):
     if no_method or both_methods:
         ctx.fail("one of --bycontent or --byname must be set to preform dedup"
                 f"got byname={byname} and bycontent={bycontent}")
+    if across and byname:
+        ctx.fail("--across only supports --bycontent")
     if bycontent:
         dup_manager.detect_method = "bycontent"
+        if cache:
+            cache_file = lib.Path(click.get_app_dir('foundryWorldTools')) / "hashcache.sqlite"
+            dup_manager.hash_cache = lib.FWTHashCache(cache_file)
     elif byname:
         dup_manager.detect_method = "byname"
     for pp in preferred: dup_manager.add_preferred_pattern(pp)
     dup_manager.add_file_extensions(ext)
-    dup_manager.scan()
-    dup_manager.set_preferred_on_all()
-    dup_manager.generate_rewrite_queue()
-    dup_manager.process_file_queue()
-    dup_manager.process_rewrite_queue()
+    dup_manager.jobs = jobs
+    try:
+        dup_manager.scan()
+        dup_manager.set_preferred_on_all()
+        dup_manager.generate_rewrite_queue()
+        if plan_out:
+            write_plan(dup_manager,plan_out)
+            return
+        dup_manager.process_file_queue()
+        dup_manager.process_rewrite_queue()
+    finally:
+        if dup_manager.hash_cache:
+            dup_manager.hash_cache.close()
+    if across:
+        action = "linked" if hardlink else "moved to the trash"
+        click.echo(f"Found {len(dup_manager.sets)} files shared between "
+                   f"projects, {dup_manager.reclaimed} bytes of copies {action}")
 
 @cli.command()
 @click.option('--ext',multiple=True,
@@ -150,15 +249,21 @@ def dedup(ctx,dir,ext,preferred,byname,bycontent,exclude_dir):
     help='/pattern/replacment/ similar to sed for rewriting file names')
 @click.option('--lower',is_flag=True,default=False,
     help='convert file names to lower case')
+@click.option('--jobs',type=click.IntRange(min=1),default=1,
+    help='number of databases to rewrite at the same time')
+@click.option('--plan-out',type=click.Path(dir_okay=False),
+    help=('write the renames and database changes to a plan file instead '
+    'of changing anything. See the apply command.'))
 @click.argument('dir',type=click.Path(exists=True,file_okay=False))
 @click.pass_context
-def renameall(ctx,dir,ext,remove,replace,lower):
+def renameall(ctx,dir,ext,remove,replace,lower,jobs,plan_out):
     """Scans files, renames based on a pattern and updates the world databases.
     
     DIR should be a directory containing a world.json file"""
     logging.debug(f"renameall started with options {lib.json.dumps(ctx.params)}")
     dir = lib.FWTPath(dir)
     file_manager = lib.FWTFileManager(dir)
+    open_ref_index(ctx,file_manager)
     preset = ctx.obj.get('PRESET',None)
     if preset:
         ext += tuple(preset.get('ext',()))
@@ -168,25 +273,69 @@ def renameall(ctx,dir,ext,remove,replace,lower):
     if not remove and not replace and not lower:
         ctx.fail("no action reqested set an option")
     file_manager.add_file_extensions(ext)
+    file_manager.jobs = jobs
     for pattern in remove:
         file_manager.add_remove_pattern(pattern)
     for pattern_set in replace:
         file_manager.add_replace_pattern(pattern_set)
     file_manager.scan()
     file_manager.generate_rewrite_queue(lower)
+    if plan_out:
+        write_plan(file_manager,plan_out)
+        return
     file_manager.process_file_queue()
     file_manager.process_rewrite_queue()
 
 @cli.command()
-@click.argument('src',type=click.Path(exists=True,file_okay=True,
+@click.argument('src',required=False,type=click.Path(exists=True,file_okay=True,
     resolve_path=True))
-@click.argument('target',type=click.Path(exists=False))
+@click.argument('target',required=False,type=click.Path(exists=False))
 @click.option('--keep-src',is_flag=True,default=False,
     help='keep source file')
+@click.option('--from-map',type=click.Path(exists=True,dir_okay=False),
+    help=('a CSV, JSON or YAML file of src and target paths to rename. '
+    'The databases are rewritten once for all of the files.'))
+@click.option('--jobs',type=click.IntRange(min=1),default=1,
+    help='number of databases to rewrite at the same time')
+@click.option('--link-mode',type=click.Choice(tuple(lib.LINK_MODES)),
+    default='copy',help=('how files are copied with --keep-src. auto tries '
+    'a reflink, then a hard link, then a copy'))
 @click.pass_context
-def rename(ctx,src,target,keep_src):
+def rename(ctx,src,target,keep_src,from_map,jobs,link_mode):
     """Rename a file and update the project databases"""
     logging.debug(f"rename started with options {lib.json.dumps(ctx.params)}")
+    if from_map:
+        if src or target:
+            ctx.fail("SRC and TARGET can't be used with --from-map")
+        try:
+            rename_map = lib.load_rename_map(from_map)
+        except (lib.FWTFileError,ValueError,lib.yaml.YAMLError) as e:
+            ctx.fail(f"unable to load rename map: {e}")
+        if not rename_map:
+            ctx.fail(f"no files to rename in {from_map}")
+        project_dir = None
+        for path in rename_map[0]:
+            path = lib.FWTPath(path,exists=False)
+            if path.is_project:
+                project_dir = path.to_fpd()
+                break
+        if not project_dir:
+            ctx.fail("No project directory found!")
+        fm = lib.FWTFileManager(project_dir)
+        fm.jobs = jobs
+        fm.link_mode = link_mode
+        open_ref_index(ctx,fm)
+        try:
+            fm.add_rename_map(rename_map,keep_src)
+        except lib.FWTFileError as e:
+            ctx.fail(str(e))
+        fm.generate_rewrite_queue()
+        fm.process_file_queue()
+        fm.process_rewrite_queue()
+        report_copies(fm)
+        return
+    if not src or not target:
+        ctx.fail("SRC and TARGET are required unless --from-map is used")
     src = lib.FWTPath(src)
     target = lib.FWTPath(target,exists=False)
  
@@ -198,6 +347,8 @@ def rename(ctx,src,target,keep_src):
 
     if src.is_project_dir():
         fm = lib.FWTFileManager(src.to_fpd())
+        fm.jobs = jobs
+        fm.link_mode = link_mode
         fm.rename_world(target,keep_src)
     else:
         if src.is_project:        
@@ -206,6 +357,9 @@ def rename(ctx,src,target,keep_src):
             fm = lib.FWTFileManager(target.to_fpd())
         else:
             ctx.fail("No project directory found!")
+        fm.jobs = jobs
+        fm.link_mode = link_mode
+        open_ref_index(ctx,fm)
         src_fwtfile = fm.add_file(src)
         src_fwtfile.new_path = target
         if keep_src:
@@ -213,15 +367,25 @@ def rename(ctx,src,target,keep_src):
         fm.generate_rewrite_queue()
         fm.process_file_queue()
         fm.process_rewrite_queue()
+    report_copies(fm)
 
 @cli.command()
 @click.pass_context
 @click.argument('dir',type=click.Path(exists=True))
-@click.option('--type',
-    help='Database type. Currently supports actors and items')
+@click.option('--type',type=click.Choice(lib.DOWNLOAD_TYPES + ('packs','all')),
+    help='Database type to download images for, packs or all')
 @click.option('--asset-dir',
     help='Directory in the world root to store images')
-def download(ctx,dir,type,asset_dir):
+@click.option('--jobs',type=click.IntRange(min=1),default=4,
+    help='number of files to download at the same time')
+@click.option('--host-rate',type=click.FloatRange(min=0,min_open=True),
+    help='maximum number of requests per second to a single host')
+@click.option('--probe-cache/--no-probe-cache',default=True,
+    help='remember the roll20 image sizes found between runs')
+@click.option('--download-cache/--no-download-cache',default=True,
+    help=('keep downloaded files in a cache, unchanged files are not '
+    'downloaded again'))
+def download(ctx,dir,type,asset_dir,jobs,host_rate,probe_cache,download_cache):
     """Download linked assets to the project directory"""
     logging.debug(f"download started with options {lib.json.dumps(ctx.params)}")
     if not type:
@@ -230,23 +394,45 @@ def download(ctx,dir,type,asset_dir):
         ctx.fail("Missing required option --asset-dir")
     project_dir = lib.FWTPath(dir,require_project=True)
     dbs = lib.FWTProjectDb(project_dir,driver=lib.FWTNeDB)
-    downloader = lib.FWTAssetDownloader(project_dir)
-    if type == 'actors':
-        for actor in dbs.data.actors:
-            downloader.download_actor_images(actor,asset_dir)
-        dbs.data.actors.save()
-    elif type == 'items':
-        for item in dbs.data.items:
-            downloader.download_item_images(item,asset_dir)
-        dbs.data.items.save()
+    app_dir = lib.Path(click.get_app_dir('foundryWorldTools'))
+    probe_cache = app_dir / "r20probes.json" if probe_cache else None
+    if download_cache:
+        download_cache = lib.FWTDownloadCache(app_dir / "downloads")
+    else:
+        download_cache = None
+    downloader = lib.FWTAssetDownloader(project_dir,jobs=jobs,
+        host_rate=host_rate,probe_cache=probe_cache,
+        download_cache=download_cache)
+    if type == 'all':
+        types = lib.DOWNLOAD_TYPES + ('packs',)
+        asset_dirs = {t:lib.Path(asset_dir) / t for t in types}
     else:
-        ctx.fail("--type only allows 'actors' or 'items'")
+        types = (type,)
+        asset_dirs = {type:lib.Path(asset_dir)}
+    scan = []
+    for t in types:
+        if t == 'packs':
+            scan.extend((db,None,asset_dirs[t] / name)
+                        for name,db in vars(dbs.packs).items())
+        elif hasattr(dbs.data,t):
+            scan.append((getattr(dbs.data,t),t,asset_dirs[t]))
+    edited = [(db,downloader.download_db_images(db,db_asset_dir,doc_type))
+              for db,doc_type,db_asset_dir in scan]
+    downloader.process_download_queue()
+    for db,docs in edited:
+        if docs:
+            db.replace_documents(docs)
 
 @cli.command()
 @click.pass_context
 @click.option('--from','_from',type=click.Path(exists=True))
 @click.option('--to',type=click.Path(exists=True))
-def pull(ctx,_from,to):
+@click.option('--jobs',type=click.IntRange(min=1),default=1,
+    help='number of databases to rewrite at the same time')
+@click.option('--link-mode',type=click.Choice(tuple(lib.LINK_MODES)),
+    default='copy',help=('how files are copied. auto tries a reflink, then '
+    'a hard link, then a copy'))
+def pull(ctx,_from,to,jobs,link_mode):
     logging.debug(f"pull command started with options {lib.json.dumps(ctx.params)}")
     """Pull assets from external projects"""
     if not _from:
@@ -254,10 +440,238 @@ def pull(ctx,_from,to):
     if not to:
         ctx.fail("Missing required option --to")
     fm = lib.FWTFileManager(to)
+    fm.jobs = jobs
+    fm.link_mode = link_mode
+    open_ref_index(ctx,fm)
     fm.find_remote_assets(_from)
     fm.generate_rewrite_queue()
     fm.process_file_queue()
     fm.process_rewrite_queue()
+    report_copies(fm)
+
+@cli.command()
+@click.option('--ext',multiple=True,
+    help=('file extension filter. May be used multiple times. Defaults to '
+    'image, audio and video files.'))
+@click.option('--exclude-dir',multiple=True,
+    help="Directory name or path to exclude. May be used multiple times.")
+@click.option('--trash',is_flag=True,default=False,
+    help='move the unreferenced files to the trash directory')
+@click.argument('dir',type=click.Path(exists=True,file_okay=False))
+@click.pass_context
+def gc(ctx,dir,ext,exclude_dir,trash):
+    """Find files which aren't used by the project databases.
+
+    DIR should be a directory containing a world.json or module.json file"""
+    logging.debug(f"gc command started with options {lib.json.dumps(ctx.params)}")
+    preset = ctx.obj.get('PRESET',None)
+    if preset:
+        ext += tuple(preset.get('ext',[]))
+        exclude_dir += tuple(preset.get('exclude-dir',[]))
+    fm = lib.FWTFileManager(dir)
+    open_ref_index(ctx,fm,required=True)
+    fm.add_file_extensions(ext or lib.ASSET_EXTENSIONS)
+    for d in exclude_dir:
+        fm.add_exclude_dir(d)
+    fm.scan()
+    orphans = fm.find_orphans()
+    o = []
+    total = 0
+    for rpp,f in sorted((f.path.as_rpp(),f) for f in orphans):
+        size = f.path.stat().st_size
+        total += size
+        o.append(f"{size}\t{rpp}")
+    if trash:
+        for f in orphans:
+            f.trash()
+        o.append(f"Moved {len(orphans)} unreferenced files, {total} bytes,"
+                 f" to {fm.trash_dir}")
+    else:
+        o.append(f"{len(orphans)} unreferenced files, {total} bytes")
+    click.echo("\n".join(o))
+
+@cli.command()
+@click.argument('dir',type=click.Path(exists=True,file_okay=False))
+@click.pass_context
+def verify(ctx,dir):
+    """Check that the files used by the project databases exist.
+
+    DIR should be a directory containing a world.json or module.json file"""
+    logging.debug(f"verify command started with options {lib.json.dumps(ctx.params)}")
+    fm = lib.FWTFileManager(dir)
+    open_ref_index(ctx,fm,required=True)
+    missing = fm.ref_index.missing()
+    fpd = fm.project_dir.as_fpd()
+    o = []
+    for db,refs in groupby(missing,key=lambda ref: ref[0]):
+        o.append(os.path.relpath(db,fpd))
+        for _,_id,field,asset in refs:
+            o.append(f"    {_id} {field}: {asset}" if _id else
+                     f"    {field}: {asset}")
+    unchecked = fm.ref_index.unchecked()
+    if unchecked:
+        o.append("Not checked, outside of the Foundry data directory:")
+        counts = Counter(asset for *_,asset in unchecked)
+        for asset,n in sorted(counts.items()):
+            o.append(f"    {asset} ({n} references)")
+        o.append(f"{len(unchecked)} references to {len(counts)} files"
+                 " weren't checked")
+    files = len({asset for *_,asset in missing})
+    o.append(f"{len(missing)} references to {files} missing files")
+    click.echo("\n".join(o))
+    if missing:
+        ctx.exit(1)
+
+@cli.command()
+@click.pass_context
+@click.argument('dir',type=click.Path(exists=True))
+def compact(ctx,dir):
+    """Remove old versions and deleted documents from project databases"""
+    logging.debug(f"compact command started with options {lib.json.dumps(ctx.params)}")
+    dbs = lib.FWTProjectDb(dir,driver=lib.FWTNeDB)
+    o = []
+    saved = 0
+    for db in dbs:
+        before,after = db.compact()
+        saved += before - after
+        if before != after:
+            o.append(f"{db.path}: {before} -> {after} bytes")
+    o.append(f"Saved {saved} bytes")
+    click.echo("\n".join(o))
+
+@cli.command()
+@click.argument('plan_file',type=click.Path(exists=True,dir_okay=False))
+@click.option('--jobs',type=click.IntRange(min=1),default=1,
+    help='number of databases to rewrite at the same time')
+@click.pass_context
+def apply(ctx,plan_file,jobs):
+    """Apply a plan written by dedup or renameall with --plan-out.
+
+    The files of the plan are checked first and nothing is changed if any
+    of them were changed since the plan was made."""
+    logging.debug(f"apply started with options {lib.json.dumps(ctx.params)}")
+    try:
+        manager = lib.load_plan(plan_file)
+    except (lib.FWTFileError,KeyError,ValueError) as e:
+        ctx.fail(f"unable to apply plan: {e}")
+    manager.jobs = jobs
+    open_ref_index(ctx,manager)
+    manager.process_file_queue()
+    manager.process_rewrite_queue()
+
+def batch_commands():
+    """the commands which take a project DIR argument"""
+    return sorted(name for name,command in cli.commands.items()
+                  if name != "batch" and any(isinstance(p,click.Argument) and p.name in ("dir","dirs")
+                         for p in command.params))
+
+def _init_batch_worker(obj,foundry_user_dir,loglevel):
+    """set up a batch worker process like the cli group does"""
+    global _batch_obj
+    _batch_obj = obj
+    lib.FWTPath.foundry_user_dir = foundry_user_dir
+    logging.getLogger().setLevel(loglevel)
+
+def _run_batch_job(command,args,dir):
+    """
+    run a command on one project in a batch worker, returns the exit
+    status, output and run time. Errors only fail this project.
+    """
+    start = time.monotonic()
+    out = io.StringIO()
+    status = 0
+    obj = dict(_batch_obj)
+    try:
+        with redirect_stdout(out), redirect_stderr(out):
+            status = cli.commands[command].main(args=[*args,dir],
+                prog_name=f"fwt {command}",obj=obj,standalone_mode=False)
+    except click.ClickException as e:
+        e.show(file=out)
+        status = e.exit_code
+    except click.Abort:
+        status = 1
+    except SystemExit as e:
+        status = e.code if isinstance(e.code,int) else 1
+    except Exception as e:
+        logging.debug(f"batch: {command} failed for {dir}",exc_info=True)
+        out.write(f"Error: {type(e).__name__}: {e}\n")
+        status = 1
+    if not isinstance(status,int):
+        status = 0
+    return status,out.getvalue(),time.monotonic() - start
+
+@cli.command()
+@click.option('--command','command_line',
+    help='the command and options to run on each project, e.g. "dedup --bycontent"')
+@click.option('--preset','preset_name',
+    help='run the command of a preset with the preset options')
+@click.option('--jobs',type=click.IntRange(min=1),default=1,
+    help='number of projects to process at the same time')
+@click.argument('dirs',nargs=-1,required=True,metavar='DIR...')
+@click.pass_context
+def batch(ctx,command_line,preset_name,jobs,dirs):
+    """Run a command on many worlds and modules.
+
+    Each DIR, or each project matching a DIR glob, is processed by a pool
+    of worker processes. A failure only stops the project it happens in.
+    The output of every project and a summary are shown at the end."""
+    logging.debug(f"batch started with options {lib.json.dumps(ctx.params)}")
+    args = shlex.split(command_line or "")
+    obj = {k:v for k,v in ctx.obj.items() if k != 'PRESET'}
+    if preset_name:
+        presets = ctx.obj['CONFIG'].get("presets",{})
+        if preset_name not in presets:
+            ctx.fail(f"Preset not found. Presets avaliable are: "
+                     f" {', '.join(presets.keys())}")
+        obj['PRESET'] = presets[preset_name]
+        if not args:
+            args = [obj['PRESET']['command']]
+        elif not args[0] in obj['PRESET']['command']:
+            ctx.fail(f"Preset {preset_name} is not a valid preset for the"
+                     f" {args[0]} command")
+    if not args:
+        ctx.fail("one of --command or --preset is required")
+    command,args = args[0],args[1:]
+    if command not in batch_commands():
+        ctx.fail(f"batch can't run {command}, commands are: "
+                 f"{', '.join(batch_commands())}")
+    projects = {}
+    for pattern in dirs:
+        paths = [pattern] if os.path.exists(pattern) else sorted(glob.glob(pattern))
+        if not paths:
+            logging.warning(f"batch: {pattern} doesn't match any directory")
+        for path in paths:
+            path = lib.FWTPath(path)
+            if path.is_dir() and path.is_project:
+                projects.setdefault(path.to_fpd().as_rpd(),path.to_fpd().as_posix())
+            else:
+                logging.warning(f"batch: skipping {path}, not a project")
+    if not projects:
+        ctx.fail("no projects found")
+    results = {}
+    with ProcessPoolExecutor(max_workers=min(jobs,len(projects)),
+            initializer=_init_batch_worker,
+            initargs=(obj,lib.FWTPath.foundry_user_dir,
+                      logging.getLogger().level)) as pool:
+        futures = {rpd:pool.submit(_run_batch_job,command,args,dir)
+                   for rpd,dir in projects.items()}
+        for rpd,job in futures.items():
+            try:
+                results[rpd] = job.result()
+            except Exception as e:
+                results[rpd] = (1,f"Error: worker failed: {e}\n",0)
+    o = []
+    failed = [rpd for rpd,(status,_,_) in results.items() if status]
+    for rpd,(status,output,elapsed) in results.items():
+        o.append(f"{rpd}: {'failed' if status else 'ok'} ({elapsed:.1f}s)")
+        o.extend(f"    {line}" for line in output.splitlines())
+    o.append(f"{len(results)} projects, {len(results) - len(failed)} ok, "
+             f"{len(failed)} failed")
+    if failed:
+        o.append(f"Failed: {' '.join(failed)}")
+    click.echo("\n".join(o))
+    if failed:
+        ctx.exit(1)
 
 @cli.command()
 @click.pass_context
@@ -2,26 +2,61 @@ import os
 import sys
 import json
 import logging
-import filecmp
+import hashlib
 import re
 import errno
 import shutil
 import stat
 import random
 import string
+import sqlite3
+import time
+import mmap
+import csv
+import yaml
 import jsonlines
 import urllib.request
 import urllib.parse
+import urllib.error
+import http.client
+import threading
 from pathlib import Path
-from itertools import tee,chain
+from bisect import bisect_left
+from functools import partial
+from itertools import tee,chain,groupby,islice,count
 from tempfile import gettempdir
 from collections import UserDict
 from types import SimpleNamespace
 from contextlib import AbstractContextManager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
 from pathlib import Path as _Path_, _windows_flavour, _posix_flavour
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 __version__ = '0.4.8'
 LOG_LEVELS = ["ERROR","INFO","WARNING","DEBUG"]
+HASH_BLOCK_SIZE = 4096
+DOWNLOAD_TYPES = ("actors","items","scenes","journal","tables")
+ASSET_EXTENSIONS = (".png",".jpg",".jpeg",".webp",".gif",".svg",".bmp",
+                    ".tif",".tiff",".avif",".mp3",".ogg",".oga",".wav",
+                    ".flac",".m4a",".opus",".webm",".mp4",".m4v")
+# the methods tried, in order, by each link mode of copy_file
+LINK_MODES = {"copy":("copy",),
+              "hardlink":("hardlink","copy"),
+              "reflink":("reflink","copy"),
+              "auto":("reflink","hardlink","copy")}
+FICLONE = 0x40049409
+# seconds to wait for another fwt process to release a sqlite cache
+SQLITE_TIMEOUT = 60
+PLAN_VERSION = 1
+# bumped when the keys stored by FWTRefIndex change
+REF_INDEX_VERSION = 2
 
 def find_list_dups(c):
         '''sort/tee/izip'''
@@ -41,6 +76,72 @@ def cpSecPerm(src,target):
         os.chown(target, st.st_uid, st.st_gid)
     shutil.copymode(src, target)
 
+def reflink(src,dst):
+    """
+    create dst as a clone of src sharing its data blocks. Raises OSError
+    when the filesystem doesn't support reflinks.
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP,"reflinks are not supported",src)
+    with open(src,'rb') as s, open(dst,'xb') as d:
+        try:
+            fcntl.ioctl(d.fileno(),FICLONE,s.fileno())
+        except OSError:
+            cloned = False
+        else:
+            cloned = True
+    if not cloned:
+        os.unlink(dst)
+        raise OSError(errno.EOPNOTSUPP,"reflinks are not supported",src)
+    shutil.copystat(src,dst)
+
+def copy_file(src,dst,link_mode="copy",stats=None):
+    """
+    copy src to dst with the first method of link_mode in LINK_MODES which
+    works and return the method used. The size of dst is added to stats.
+    """
+    for method in LINK_MODES[link_mode]:
+        try:
+            if method == "reflink":
+                reflink(src,dst)
+            elif method == "hardlink":
+                os.link(src,dst)
+            else:
+                shutil.copy2(src,dst)
+        except OSError as e:
+            if method == "copy":
+                raise
+            logging.debug(f"copy_file: {method} of {src} failed: {e}")
+            continue
+        break
+    if stats is not None:
+        stats.add(method,os.stat(dst).st_size)
+    return method
+
+class FWTCopyStats:
+    """counts the files and bytes copied with each copy_file method"""
+    def __init__(self):
+        self.files = {}
+        self.bytes = {}
+
+    def add(self,method,size):
+        self.files[method] = self.files.get(method,0) + 1
+        self.bytes[method] = self.bytes.get(method,0) + size
+
+    @property
+    def copied_bytes(self):
+        return self.bytes.get("copy",0)
+
+    @property
+    def linked_bytes(self):
+        return self.bytes.get("hardlink",0) + self.bytes.get("reflink",0)
+
+    def __str__(self):
+        return ", ".join(f"{method}: {self.files[method]} files "
+                         f"{self.bytes[method]} bytes"
+                         for method in ("copy","hardlink","reflink")
+                         if method in self.files) or "no files copied"
+
 def find_next_avaliable_path(output_path):
     output_path = Path(output_path)
     n = int(output_path.suffix[1:])
@@ -49,19 +150,101 @@ def find_next_avaliable_path(output_path):
         output_path = output_path.with_suffix(f".{n}")
     return output_path
 
-def find_foundry_user_dir(search_path):
+def find_in_parents(path,find,cache):
+    """
+    Return find(d) for the nearest of path and its parent directories
+    where it isn't None. The result is stored in cache for every directory
+    walked so later lookups below the same directories are dict hits.
+    """
+    path = _Path_(path)
+    if path.as_posix() not in cache and not path.is_dir():
+        path = path.parent
+    walked = []
+    found = None
+    for d in (path,*path.parents):
+        key = d.as_posix()
+        if key in cache:
+            found = cache[key]
+            break
+        walked.append(key)
+        found = find(d)
+        if found is not None:
+            break
+    for key in walked:
+        cache[key] = found
+    return found
+
+_fud_dirs = {}
+_manafest_dirs = {}
+_manafest_info = {}
+
+def clear_path_cache():
+    """forget cached foundry user dirs and project manifests"""
+    _fud_dirs.clear()
+    _manafest_dirs.clear()
+    _manafest_info.clear()
+
+def _fud_from_options(d):
     try:
-        search_path = Path(search_path)
-        fvtt_options = Path(
-            next(f for p in (search_path,*search_path.parents)
-                for f in p.glob("Config/*.json")
-                if f.name == "options.json")
-            )   
-        data_path = json.load(fvtt_options.open())['dataPath']
-        foundry_user_dir = Path(data_path) / "Data"
+        fvtt_options = next(f for f in d.glob("Config/*.json")
+                            if f.name == "options.json")
     except StopIteration:
-        foundry_user_dir = False
-    return foundry_user_dir
+        return None
+    data_path = json.load(fvtt_options.open())['dataPath']
+    return Path(data_path) / "Data"
+
+def find_foundry_user_dir(search_path):
+    foundry_user_dir = find_in_parents(search_path,_fud_from_options,_fud_dirs)
+    return foundry_user_dir if foundry_user_dir else False
+
+def _manafest_in_dir(d):
+    return next((f for f in d.glob("*.json")
+                 if f.name in FWTPath.project_manafests),None)
+
+def find_project_manafest(path):
+    """
+    Return (manafest path, project type, project name) for the project
+    containing path or None. The manifest is read again when its mtime or
+    size changes.
+    """
+    manafest = find_in_parents(path,_manafest_in_dir,_manafest_dirs)
+    if manafest is None:
+        return None
+    try:
+        st = manafest.stat()
+    except FileNotFoundError:
+        clear_path_cache()
+        return find_project_manafest(path)
+    info = _manafest_info.get(manafest)
+    if not info or info[0] != (st.st_mtime_ns,st.st_size):
+        name = json.loads(manafest.read_text())["name"]
+        info = ((st.st_mtime_ns,st.st_size),manafest.stem,name)
+        _manafest_info[manafest] = info
+    return manafest,info[1],info[2]
+
+def hash_file_ends(path,size,block_size=HASH_BLOCK_SIZE):
+    """hash the first and last block of a file"""
+    h = hashlib.blake2b()
+    with open(path,'rb') as f:
+        h.update(f.read(block_size))
+        if size > block_size:
+            f.seek(max(size - block_size,block_size))
+            h.update(f.read(block_size))
+    return h.hexdigest()
+
+def hash_file(path,algorithm="sha256",chunk_size=1024*1024):
+    """hash the full contents of a file without loading it into memory"""
+    h = hashlib.new(algorithm)
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size),b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def content_id(path,size):
+    """the id scan_content gives a file with size bytes"""
+    if size > 2 * HASH_BLOCK_SIZE:
+        return f"{size}-{hash_file(path)}"
+    return f"{size}-{hash_file_ends(path,size)}"
 
 def get_relative_to(path, rs):
     logging.debug(f"get_relative_to: got base {path} and rel {rs}")
@@ -118,11 +301,9 @@ def resolve_fvtt_path(fwtpath,
         symlink = True
         fwtpath._fwt_rtp = None
     if check_for_project or symlink:
-        try:
-            manafest = next(f for d in (fwtpath,*fwtpath.parents) for f in d.glob("*.json")
-                            if f.name in fwtpath.project_manafests)
-            fwtpath.project_type = f"{manafest.stem}"
-            fwtpath.project_name = json.loads(manafest.read_text())["name"]
+        project = find_project_manafest(fwtpath)
+        if project:
+            manafest,fwtpath.project_type,fwtpath.project_name = project
             fwtpath.is_project = True
             if not manafest.parent.name == fwtpath.project_name:
                 logging.warning("project directory and name are different")
@@ -134,7 +315,7 @@ def resolve_fvtt_path(fwtpath,
             else:
                 fwtpath._fwt_rpd = manafest.parent.relative_to(fwtpath._fwt_fud)
             fwtpath.manafest = fwtpath._fwt_fud / fwtpath._fwt_rpd / manafest.name
-        except StopIteration:
+        else:
             if require_project or symlink:
                 raise FWTPathError(
                     f"{path} is not part of a Foundry project"
@@ -219,6 +400,167 @@ class FUDNotFoundError(Exception):
 class FWTFileError(Exception):
     pass
 
+def trie_regex(words):
+    """
+    Build a regex alternation matching any of words, longest match first.
+    The alternation is factored into a prefix tree so the regex engine
+    only follows branches that agree with the text being searched.
+    """
+    def build(words):
+        alts = []
+        optional = False
+        for first, group in groupby(words, key=lambda w: w[:1]):
+            group = list(group)
+            if not first:
+                optional = True
+                continue
+            prefix = os.path.commonprefix(group)
+            rest = [w[len(prefix):] for w in group]
+            if len(rest) == 1:
+                alts.append(re.escape(prefix))
+            else:
+                alts.append(re.escape(prefix) + build(rest))
+        pattern = f"(?:{'|'.join(alts)})"
+        return pattern + "?" if optional else pattern
+    return build(sorted(set(words)))
+
+def starts_any(strings,targets,skip_self=False):
+    """
+    True when a tail of any of strings is the start of one of targets.
+    targets must be sorted. With skip_self a string is not compared with
+    itself.
+    """
+    heads = {t[:4] for t in targets}
+    for s in strings:
+        for p in range(len(s)):
+            tail = s[p:]
+            if len(tail) >= 4 and tail[:4] not in heads:
+                continue
+            i = bisect_left(targets,tail)
+            for t in targets[i:i+2]:
+                if skip_self and t == s:
+                    continue
+                if t.startswith(tail):
+                    return True
+                break
+    return False
+
+class FWTRewriteSegment:
+    """
+    A run of consecutive str entries from a rewrite batch compiled into a
+    single matcher. When no key can overlap another key or a replacement
+    the order of the entries doesn't matter and lines are rewritten in one
+    regex pass. Otherwise lines containing a key fall back to calling
+    str.replace for each entry in order.
+    """
+    def __init__(self,items):
+        self.items = items
+        self.table = dict(items)
+        self.regex = re.compile(trie_regex(self.table.keys()))
+        self.single_pass = self._independent()
+
+    def _independent(self):
+        keys = sorted(self.table.keys())
+        values = sorted(set(self.table.values()))
+        if not keys[0] or not values[0]:
+            return False
+        # a key overlapping another key
+        if (starts_any(keys,keys,skip_self=True)
+                or any(self.regex.search(k,1) for k in keys)):
+            return False
+        # a replacement that could form a key with the text around it
+        if (starts_any(values,keys) or starts_any(keys,values)
+                or self.regex.search("\0".join(values))
+                or re.search(trie_regex(values),"\0".join(keys))):
+            return False
+        return True
+
+    def replace_each(self,line):
+        for find,replace in self.items:
+            line = line.replace(find,replace)
+        return line
+
+    def __call__(self,line):
+        if not self.regex.search(line):
+            return line
+        if not self.single_pass:
+            return self.replace_each(line)
+        table = self.table
+        return self.regex.sub(lambda m: table[m.group()],line)
+
+class FWTRewriter:
+    """
+    Rewrites text using a batch of find/replace pairs. find may be a str or
+    a compiled regex. The result is the same as applying each pair in
+    order, but runs of str pairs are matched together in a single pass.
+    """
+    def __init__(self,batch,quote_find=False):
+        self._steps = []
+        items = []
+        for find,replace in batch.items():
+            if type(find) == str:
+                if quote_find:
+                    find,replace = f'"{find}"',f'"{replace}"'
+                items.append((find,replace))
+            elif type(find) == re.Pattern:
+                if items:
+                    self._steps.append(FWTRewriteSegment(items))
+                    items = []
+                self._steps.append(partial(find.sub,replace))
+            else:
+                raise ValueError("invalid member or rewrite queue")
+        if items:
+            self._steps.append(FWTRewriteSegment(items))
+        # regex entries can't be searched for without decoding the file
+        if len(self._steps) == 1 and isinstance(self._steps[0],FWTRewriteSegment):
+            self._bytes_regex = re.compile(
+                self._steps[0].regex.pattern.encode('utf-8'))
+        else:
+            self._bytes_regex = None
+
+    def search_file(self,path):
+        """
+        True when the file at path might be changed by the batch. The file
+        is memory mapped and searched for any of the keys without decoding
+        it. Batches with regex entries always return True.
+        """
+        if self._bytes_regex is None:
+            return True
+        with open(path,'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as m:
+                return self._bytes_regex.search(m) is not None
+
+    def __call__(self,line):
+        for step in self._steps:
+            line = step(line)
+        return line
+
+def rewrite_file(file,rewrite,trash_dir=None):
+    """
+    Rewrite a file line by line with a FWTRewriter. The original is moved
+    to trash_dir. Returns False when the file was skipped because nothing
+    in it matched.
+    """
+    if not rewrite.search_file(file):
+        logging.debug(f'skipping db {file}, nothing to rewrite')
+        return False
+    logging.debug(f'opening db {file} for rewrite')
+    with FWTFileWriter(file,read_fd=True,trash_dir=trash_dir) as f:
+        for line in f.read_fd:
+            f.write_fd.write(rewrite(line))
+    return True
+
+_worker_rewriter = None
+
+def _init_rewrite_worker(batch,quote_find):
+    global _worker_rewriter
+    _worker_rewriter = FWTRewriter(batch,quote_find)
+
+def _rewrite_file_worker(file,trash_dir):
+    return rewrite_file(file,_worker_rewriter,trash_dir)
+
 class FWTFileManager:
     """manage project files and update foundry db when file paths change"""
     def __init__(self,project_dir,trash_dir="trash"):
@@ -228,9 +570,10 @@ class FWTFileManager:
         if trash_dir:
             if not _Path_(trash_dir).is_absolute():
                 trash_dir = self.project_dir / trash_dir
+            # created by the first file moved to it, so a run which only
+            # writes a plan leaves the project unchanged
             self.trash_dir = find_next_avaliable_path(
                 trash_dir / "session.0")
-            self.trash_dir.mkdir(parents=True,exist_ok=True)
         else:
             self.trash_dir = None
         self._dir_exclusions = set()
@@ -242,6 +585,10 @@ class FWTFileManager:
         self.rewrite_names_pattern = None
         self.remove_patterns = []
         self.replace_patterns = []
+        self.jobs = 1
+        self.ref_index = None
+        self.link_mode = "copy"
+        self.copy_stats = FWTCopyStats()
         self._dbs = FWTProjectDb(self.project_dir,FWTTextDb,self.trash_dir)
 
     @property
@@ -287,7 +634,8 @@ class FWTFileManager:
     def add_exclude_dir(self,dir):
         self._dir_exclusions.add(dir)
 
-    def scan(self):
+    def scanner(self):
+        """return a FWTScan of the project using the extension and dir filters"""
         scanner = FWTScan(self.project_dir)
         if len(self.file_extensions):
             ext_filter = FileExtensionsFilter()
@@ -297,7 +645,10 @@ class FWTFileManager:
             dir_filter = DirNamesFilter()
             for d in self._dir_exclusions: dir_filter.add_match(d)
             scanner.add_filter(dir_filter) 
-        for f in scanner:
+        return scanner
+
+    def scan(self):
+        for f in self.scanner():
             self.add_file(f)
 
 
@@ -336,7 +687,7 @@ class FWTFileManager:
         """do file renames and deletions"""
         for f in self._files:
             if f.new_path and f.keep_src:
-                f.copy()
+                f.copy(link_mode=self.link_mode,stats=self.copy_stats)
             elif f.new_path:
                 f.rename()
 
@@ -355,45 +706,193 @@ class FWTFileManager:
         self._files.append(file)
         return file
 
+    def add_rename_map(self,rename_map,keep_src=False):
+        """
+        Add files to be renamed from a sequence of (src, target) pairs.
+        Every pair is checked before any file is added and a FWTFileError
+        listing all of the problems is raised if any pair is invalid.
+        """
+        errors = []
+        files = []
+        sources = set()
+        targets = set()
+        for src,target in rename_map:
+            try:
+                file = FWTFile(src,self.trash_dir,keep_src=keep_src)
+                file.new_path = target
+                if not file.new_path:
+                    raise FWTFileError("source and target are the same file")
+            except (FWTPathError,FWTFileError) as e:
+                errors.append(f"{src} -> {target}: {e}")
+                continue
+            path,new_path = file.path,file.new_path
+            src_rtp,target_rtp = path.as_rtp(),new_path.as_rtp()
+            if new_path.exists():
+                errors.append(f"{src} -> {target}: {new_path} exists")
+            if src_rtp in sources:
+                errors.append(f"{src} -> {target}: {path} is renamed twice")
+            if target_rtp in targets:
+                errors.append(f"{src} -> {target}: more than one file "
+                              f"renamed to {new_path}")
+            if path.is_dir():
+                errors.append(f"{src} -> {target}: only files can be renamed"
+                              " from a map")
+            rpds = {p.as_rpd() for p in (path,new_path) if p.is_project}
+            if self.project_dir.as_rpd() not in rpds:
+                errors.append(f"{src} -> {target}: neither path is in "
+                              f"project {self.project_dir.as_rpd()}")
+            elif len(rpds) > 1 and not keep_src:
+                errors.append(f"{src} -> {target}: renames between "
+                              "projects are only supported with keep_src")
+            sources.add(src_rtp)
+            targets.add(target_rtp)
+            files.append(file)
+        for rtp in sources & targets:
+            errors.append(f"{rtp} is both renamed and a rename target")
+        if errors:
+            raise FWTFileError("invalid rename map:\n" + "\n".join(errors))
+        self._files.extend(files)
+        return files
+
+    def plan(self):
+        """return the queued renames and database rewrites as a plan dict"""
+        files = [f for f in self._files if f.new_path]
+        return {"version":PLAN_VERSION,
+                "command":"renameall",
+                "project_dir":self.project_dir.as_posix(),
+                "files":{f.path.as_rtp():file_identity(f.path) for f in files},
+                "renames":[[f.path.as_rtp(),f.new_path.as_rtp()] for f in files],
+                "rewrite_queue":self.rewrite_queue}
+
+    def load_plan(self,plan):
+        """
+        queue the renames and rewrites of a plan. Every file of the plan
+        is checked first and a FWTFileError listing all of the changed
+        files is raised if any file changed since the plan was made.
+        """
+        fud = self.project_dir._fwt_fud
+        check_plan_files(fud,plan["files"])
+        files = []
+        errors = []
+        for src,target in plan["renames"]:
+            file = FWTFile(fud / src,self.trash_dir)
+            file.new_path = fud / target
+            if file.new_path and file.new_path.exists():
+                errors.append(f"{target}: exists")
+            files.append(file)
+        if errors:
+            raise FWTFileError("plan can't be applied:\n" + "\n".join(errors))
+        self._files.extend(files)
+        self.rewrite_queue = plan["rewrite_queue"]
+
     def db_replace(self,batch,quote_find=False):
+        dbs = sorted(self.project_dir.glob("*/*db"))
+        if self.ref_index and all(type(find) == str for find in batch):
+            # the index only puts the databases known to reference a renamed
+            # file first. Every database is still searched by rewrite_file,
+            # so a reference the index missed is rewritten too.
+            referenced = set(self.ref_index.dbs_referencing(batch))
+            dbs.sort(key=lambda db: db not in referenced)
         self.files_replace(
-                            (self.project_dir.manafest,
-                            *self.project_dir.glob("*/*db")),
+                            (self.project_dir.manafest,*dbs),
                             batch,quote_find
                         )
 
     def files_replace(self,files,batch,quote_find=False):
-        for file in files:
-            logging.debug(f'opening db {file} for rewrite')
-
-            with FWTFileWriter(file,read_fd=True,trash_dir=self.trash_dir) as f:
-                for idx,line in enumerate(f.read_fd):
-                    for find,replace in batch.items():
-                        if type(find) == str: 
-                            if quote_find: 
-                                find,replace = f'"{find}"',f'"{replace}"'
-                            line = line.replace(find,replace)
-                        elif type(find) == re.Pattern:
-                            line = find.sub(replace,line)
-                        else:
-                            raise ValueError("invalid member or rewrite queue")
-                    f.write_fd.write(line)
+        """
+        Rewrite files with a batch of find/replace pairs. With more than one
+        job the files are rewritten on a process pool, largest first. Files
+        that fail don't stop the others, all failures are raised together
+        in a FWTFileError.
+        """
+        files = [Path(f) for f in files]
+        errors = []
+        if self.jobs > 1 and len(files) > 1:
+            files.sort(key=lambda f: f.stat().st_size,reverse=True)
+            with ProcessPoolExecutor(max_workers=min(self.jobs,len(files)),
+                                     initializer=_init_rewrite_worker,
+                                     initargs=(batch,quote_find)) as pool:
+                jobs = [(file,pool.submit(_rewrite_file_worker,
+                            file.as_posix(),self.trash_dir)) for file in files]
+                for file,job in jobs:
+                    try:
+                        job.result()
+                    except Exception as err:
+                        errors.append(f"{file}: {err}")
+        else:
+            rewrite = FWTRewriter(batch,quote_find)
+            for file in files:
+                try:
+                    rewrite_file(file,rewrite,self.trash_dir)
+                except Exception as err:
+                    errors.append(f"{file}: {err}")
+        if errors:
+            for error in errors:
+                logging.error(f"database rewrite failed for {error}")
+            raise FWTFileError(f"{len(errors)} database rewrites failed:\n"
+                               + "\n".join(errors))
+
+    def find_orphans(self):
+        """
+        return the scanned files which aren't referenced by the manifest or
+        any database of the project. Files of other projects inside the
+        project directory are left out. ref_index must be set.
+
+        The references are normalized before they are compared and every
+        candidate is then looked for in the raw text of the databases, so
+        a file is only reported when no database mentions its path at all.
+        """
+        referenced = {normalize_ref(a) for a in self.ref_index.assets()}
+        rpd = self.project_dir.as_rpd()
+        candidates = {f.path.as_rtp():f for f in self._files
+                      if f.path.as_rpd() == rpd
+                      and f.path.as_rtp() not in referenced}
+        for rtp in self._mentioned(candidates):
+            logging.debug(f"find_orphans() {rtp} is mentioned in a database")
+            del candidates[rtp]
+        return list(candidates.values())
+
+    def _mentioned(self,paths):
+        """
+        the paths found in the raw text of the manifest or any database of
+        the project, either as is, URL quoted or JSON escaped
+        """
+        forms = {}
+        for path in paths:
+            for form in (path,urllib.parse.quote(path),json.dumps(path)[1:-1]):
+                forms[form] = path
+        if not forms:
+            return set()
+        regex = re.compile(trie_regex(forms).encode('utf-8'))
+        forms = {form.encode('utf-8'):path for form,path in forms.items()}
+        found = set()
+        for db_file in self.ref_index.db_files:
+            if not db_file.exists():
+                continue
+            with open(db_file,'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    continue
+                with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as m:
+                    found.update(forms[match] for match in regex.findall(m))
+        return found
 
     def find_remote_assets(self,src):
         src = FWTPath(src)
         remote_assets=set()
-        dbs = FWTProjectDb(self.project_dir,driver=FWTTextDb)
-        path_re = re.compile(r'(?P<path>'+src.as_rpd()+r'[^"\\]+)')
-        for db in dbs:
-            for obj in db:
-                for a in path_re.findall(obj):
-                    if a:
+        if self.ref_index:
+            remote_assets.update(self.ref_index.assets(src.as_rpd() + "/"))
+        else:
+            dbs = FWTProjectDb(self.project_dir,driver=FWTTextDb)
+            path_re = re.compile(re.escape(src.as_rpd() + "/") + r'[^"\\]+')
+            for db in dbs:
+                for obj in db:
+                    for a in path_re.findall(obj):
                         logging.debug(f"find_remote_assets() found asset {a}")
-                        remote_assets.add(a)
+                        remote_assets.add(normalize_ref(a))
         self._files = [FWTFile(src._fwt_fud / path,keep_src=True) for path in remote_assets]
         for f in self._files:
             np = f.path.as_rtp().replace(f.path.as_rpd(),self.project_dir.as_rpd())
-            f.new_path = np
+            f.new_path = src._fwt_fud / np
         
     def rename_world(self,dst,keep_src=False):
         dst = FWTPath(dst,exists=False)
@@ -406,14 +905,103 @@ class FWTFileManager:
         name_queue = {name_rewrite_match:f'"{dst.name}"'}
 
         if keep_src:
-            shutil.copytree(self.project_dir,dst)
+            shutil.copytree(self.project_dir,dst,
+                            copy_function=self._copy_project_file)
         else:
             os.renames(self.project_dir,dst)
+        clear_path_cache()
         new_project = FWTFileManager(dst)
+        new_project.jobs = self.jobs
         new_project.files_replace([new_project.project_dir.manafest,],
                     {**dir_queue,**name_queue})
         new_project.db_replace(batch=dir_queue)
 
+    def _copy_project_file(self,src,dst):
+        """
+        copy a file of the project for rename_world. Foundry appends to
+        databases in place so they are never hard linked.
+        """
+        link_mode = self.link_mode
+        rel = Path(src).relative_to(self.project_dir)
+        if rel.parts[0] in ("data","packs") or rel == Path(self.project_dir.manafest.name):
+            link_mode = {"hardlink":"copy","auto":"reflink"}.get(link_mode,link_mode)
+        copy_file(src,dst,link_mode,self.copy_stats)
+        return dst
+
+def load_rename_map(map_file):
+    """
+    Read (src, target) pairs from a CSV, JSON or YAML file. CSV files have
+    two columns and an optional src,target header. JSON and YAML files hold
+    either an object mapping src to target or a list of pairs.
+    """
+    map_file = Path(map_file)
+    suffix = map_file.suffix.lower()
+    with map_file.open(newline='',encoding='utf-8') as f:
+        if suffix == '.csv':
+            rows = [row for row in csv.reader(f) if row]
+            if rows and [c.strip().lower() for c in rows[0]] == ['src','target']:
+                rows = rows[1:]
+        elif suffix == '.json':
+            rows = json.load(f)
+        elif suffix in ('.yaml','.yml'):
+            rows = yaml.safe_load(f)
+        else:
+            raise FWTFileError(f"unsupported rename map file type {suffix}")
+    if isinstance(rows,dict):
+        rows = rows.items()
+    rename_map = []
+    for row in rows or ():
+        if len(row) != 2:
+            raise FWTFileError(f"invalid rename map entry {row} in {map_file}")
+        rename_map.append((str(row[0]).strip(),str(row[1]).strip()))
+    return rename_map
+
+def file_identity(path,id=None):
+    """the size, mtime and optional content id of a file for a plan"""
+    st = os.stat(path)
+    identity = {"size":st.st_size,"mtime_ns":st.st_mtime_ns}
+    if id:
+        identity["id"] = id
+    return identity
+
+def check_plan_files(foundry_user_dir,files):
+    """
+    check the files of a plan are unchanged. A file with a new mtime is
+    accepted when its content id still matches.
+    """
+    errors = []
+    for rtp,identity in files.items():
+        path = Path(foundry_user_dir) / rtp
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            errors.append(f"{rtp}: missing")
+            continue
+        if st.st_size != identity["size"]:
+            errors.append(f"{rtp}: size changed")
+        elif st.st_mtime_ns != identity["mtime_ns"]:
+            if identity.get("id") != content_id(path,st.st_size):
+                errors.append(f"{rtp}: modified")
+    if errors:
+        raise FWTFileError("files changed since the plan was made:\n"
+                           + "\n".join(errors))
+
+def load_plan(plan_file):
+    """
+    Read a plan file written with --plan-out and return a FWTFileManager
+    or FWTSetManager of its project with the plan queued
+    """
+    with Path(plan_file).open(encoding='utf-8') as f:
+        plan = json.load(f)
+    if not isinstance(plan,dict) or plan.get("version") != PLAN_VERSION:
+        raise FWTFileError(f"{plan_file} is not a version {PLAN_VERSION} plan")
+    managers = {"dedup":FWTSetManager,"renameall":FWTFileManager}
+    if plan.get("command") not in managers:
+        raise FWTFileError(f"unknown plan command {plan.get('command')}")
+    manager = managers[plan["command"]](plan["project_dir"])
+    manager.load_plan(plan)
+    return manager
+
 class FWTSetManager(FWTFileManager):
     """An object for managing duplicate assets"""
     def __init__(self,project_dir,detect_method=None,trash_dir="trash"):
@@ -421,6 +1009,7 @@ class FWTSetManager(FWTFileManager):
         self.preferred_patterns = []
         self.rewrite_queue = {}
         self.sets = {}
+        self.hash_cache = None
         if detect_method:
             self.detect_method = detect_method
 
@@ -442,42 +1031,93 @@ class FWTSetManager(FWTFileManager):
             f"{method}")
    
     def scan(self):
-        scanner = FWTScan(self.project_dir)
-        if len(self.file_extensions):
-            ext_filter = FileExtensionsFilter()
-            for e in self.file_extensions: ext_filter.add_match(e)
-            scanner.add_filter(ext_filter)
-        if len(self._dir_exclusions):
-            dir_filter = DirNamesFilter()
-            for d in self._dir_exclusions: dir_filter.add_match(d)
-            scanner.add_filter(dir_filter) 
-        for match in scanner:
-            if self._detect_method == "bycontent":
-                with match.open('rb') as f:
-                    id = hash(f.read(4096))
-                    if id == 0: continue # empty file
-                while not self.add_to_set(id,match):
-                    id += 1
-            elif self._detect_method == "byname":
+        scanner = self.scanner()
+        if self._detect_method == "bycontent":
+            self.scan_content(scanner)
+        elif self._detect_method == "byname":
+            for match in scanner:
                 id = (match.parent / match.stem).as_posix()
                 self.add_to_set(id,match)
 
         single_sets = [k for k,v in self.sets.items() if len(v) < 2]
         for k in single_sets:
             del self.sets[k]
-        
+
+    def scan_content(self,matches):
+        """
+        Find files with the same content. Files are grouped by size, then
+        by a hash of their first and last blocks and only the files left
+        in a group are hashed in full. Files with a unique size are never
+        opened. Hashing runs on a pool of self.jobs threads while the scan
+        continues, sets are built in scan order once hashing is done.
+        """
+        by_size = {}
+        stats = {}
+        ends = {}
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for match in matches:
+                st = match.stat()
+                if st.st_size == 0: continue # empty file
+                stats[match] = st
+                files = by_size.setdefault(st.st_size,[])
+                files.append(match)
+                if len(files) == 2:
+                    ends[files[0]] = self.submit_hash(pool,files[0],
+                                                    stats[files[0]],"ends")
+                if len(files) >= 2:
+                    ends[match] = self.submit_hash(pool,match,st,"ends")
+            full = {}
+            for size,files in by_size.items():
+                if len(files) < 2: continue
+                by_ends = {}
+                for f in files:
+                    digest = self.hash_result(f,stats[f],"ends",ends[f])
+                    by_ends.setdefault(digest,[]).append(f)
+                for digest,group in by_ends.items():
+                    if len(group) < 2: continue
+                    for f in group:
+                        # the ends hash covers all of a small file
+                        if size > 2 * HASH_BLOCK_SIZE:
+                            full[f] = self.submit_hash(pool,f,stats[f],"sha256")
+                        else:
+                            full[f] = digest
+            ids = {}
+            for f,job in full.items():
+                digest = self.hash_result(f,stats[f],"sha256",job)
+                ids[f] = f"{stats[f].st_size}-{digest}"
+        if self.hash_cache:
+            self.hash_cache.commit()
+        for files in by_size.values():
+            for f in files:
+                if f in ids:
+                    self.add_to_set(ids[f],f)
+
+    def submit_hash(self,pool,f,st,kind):
+        """
+        return the cached hash of a file or a future for hashing it on pool
+        """
+        if self.hash_cache:
+            digest = self.hash_cache.get(f,st,kind)
+            if digest:
+                return digest
+        if kind == "ends":
+            return pool.submit(hash_file_ends,f,st.st_size)
+        return pool.submit(hash_file,f,kind)
+
+    def hash_result(self,f,st,kind,job):
+        """wait for a job from submit_hash and cache the result"""
+        if not isinstance(job,Future):
+            return job
+        digest = job.result()
+        if self.hash_cache:
+            self.hash_cache.put(f,st,kind,digest)
+        return digest
+
     def add_to_set(self,id,f):
         set = self.sets.get(id,FWTSet(id,trash_dir=self.trash_dir))
         if not set.files:
             self.sets[id] = set
-            return set.add_file(f)
-        elif (self._detect_method == "bycontent" and
-              filecmp.cmp(f, set._files[0].path,shallow=False)):
-            return set.add_file(f)
-        elif self._detect_method == "byname":
-            return set.add_file(f)
-        else:
-            return False
+        return set.add_file(f)
 
 
     def process_file_queue(self):
@@ -506,6 +1146,173 @@ class FWTSetManager(FWTFileManager):
             rewrite_queue.update(fwtset.rewrite_data)
         self.rewrite_queue = rewrite_queue
 
+    def plan(self):
+        """return the sets, preferred files and rewrites as a plan dict"""
+        files = {}
+        sets = []
+        for fwtset in self.sets.values():
+            # sets found by content are checked against their content id
+            id = fwtset.id if self.detect_method == "bycontent" else None
+            for f in (fwtset.preferred,*fwtset.files):
+                files[f.path.as_rtp()] = file_identity(f.path,id)
+            sets.append({"id":fwtset.id,
+                         "preferred":fwtset.preferred.path.as_rtp(),
+                         "files":[f.path.as_rtp() for f in fwtset.files]})
+        return {"version":PLAN_VERSION,
+                "command":"dedup",
+                "project_dir":self.project_dir.as_posix(),
+                "files":files,
+                "sets":sets,
+                "rewrite_queue":self.rewrite_queue}
+
+    def load_plan(self,plan):
+        """
+        queue the sets and rewrites of a plan. Every file of the plan is
+        checked first and a FWTFileError listing all of the changed files
+        is raised if any file changed since the plan was made.
+        """
+        fud = self.project_dir._fwt_fud
+        check_plan_files(fud,plan["files"])
+        for s in plan["sets"]:
+            fwtset = FWTSet(s["id"],trash_dir=self.trash_dir)
+            fwtset.add_file(FWTPath(fud / s["preferred"]),preferred=True)
+            for rtp in s["files"]:
+                fwtset.add_file(FWTPath(fud / rtp))
+            self.sets[s["id"]] = fwtset
+        self.rewrite_queue = plan["rewrite_queue"]
+
+class FWTStoreManager(FWTSetManager):
+    """
+    An object for managing assets duplicated across projects. One copy of
+    each file found in more than one project is moved to a content addressed
+    store in the foundry user data dir and the databases of every project
+    are rewritten to use it. With hardlink set the copies are replaced by
+    hard links to the preferred file instead and no database changes.
+    """
+    def __init__(self,project_dirs,store_dir="fwt-store",trash_dir="trash"):
+        super().__init__(project_dirs[0],"bycontent",trash_dir)
+        self.projects = [self]
+        self.projects += [FWTFileManager(d,trash_dir) for d in project_dirs[1:]]
+        self._trash_dirs = {p.project_dir.as_rpd():p.trash_dir
+                            for p in self.projects}
+        store_dir = Path(store_dir)
+        if not store_dir.is_absolute():
+            store_dir = self.project_dir._fwt_fud / store_dir
+        self.store_dir = store_dir
+        self.hardlink = False
+        self.reclaimed = 0
+        self._targets = {}
+
+    def add_exclude_dir(self,dir):
+        super().add_exclude_dir(dir)
+        for project in self.projects[1:]:
+            project.add_exclude_dir(dir)
+
+    def add_file_extensions(self,e):
+        super().add_file_extensions(e)
+        for project in self.projects[1:]:
+            project.add_file_extensions(e)
+
+    def scan(self):
+        """find sets of files with the same content in more than one project"""
+        self.scan_content(chain.from_iterable(
+            self.project_files(p) for p in self.projects))
+        for k,v in list(self.sets.items()):
+            inodes = {(st.st_dev,st.st_ino) for st in
+                      (f.path.stat() for f in v.files)}
+            if len({f.path.as_rpd() for f in v.files}) < 2 or len(inodes) < 2:
+                # not shared or already hard linked
+                del self.sets[k]
+
+    def project_files(self,project):
+        """scan a project leaving out the files of projects inside it"""
+        rpd = project.project_dir.as_rpd()
+        for f in project.scanner():
+            if f.as_rpd() == rpd:
+                yield f
+
+    def add_to_set(self,id,f):
+        fwtset = self.sets.setdefault(id,FWTSet(id))
+        fwtset.files.append(FWTFile(f,self._trash_dirs[f.as_rpd()]))
+        return True
+
+    def store_path(self,fwtset):
+        """the path of the content of a set in the store"""
+        size,digest = fwtset.id.split("-",1)
+        if int(size) <= 2 * HASH_BLOCK_SIZE:
+            # small files are only hashed by hash_file_ends
+            digest = hash_file(fwtset.preferred.path)
+        suffix = fwtset.preferred.path.suffix.lower()
+        return FWTPath(self.store_dir / digest[:2] / f"{digest}{suffix}",
+                       exists=False)
+
+    def generate_rewrite_queue(self):
+        logging.info("FWT_StoreManager.generate_rewrite_queue: starting")
+        rewrite_queue = {}
+        if self.hardlink:
+            self.rewrite_queue = rewrite_queue
+            return
+        for id,fwtset in list(self.sets.items()):
+            target = self.store_path(fwtset)
+            size = int(id.split("-",1)[0])
+            if target.exists() and target.stat().st_size != size:
+                logging.error(f"store file {target} has the wrong size, "
+                              f"skipping set {id}")
+                del self.sets[id]
+                continue
+            self._targets[id] = target
+            for f in (fwtset.preferred,*fwtset.files):
+                rewrite_queue[f.path.as_rtp()] = target.as_rtp()
+        self.rewrite_queue = rewrite_queue
+
+    def process_file_queue(self):
+        """move files to the store or replace them with hard links"""
+        for id,fwtset in self.sets.items():
+            size = int(id.split("-",1)[0])
+            if self.hardlink:
+                self.link_set(fwtset,size)
+                continue
+            target = self._targets[id]
+            if target.exists():
+                fwtset.preferred.trash()
+                self.reclaimed += size
+            else:
+                fwtset.preferred.new_path = target
+                fwtset.preferred.rename()
+            for f in fwtset.files:
+                f.trash()
+                self.reclaimed += size
+
+    def link_set(self,fwtset,size):
+        """replace the files of a set with hard links to the preferred file"""
+        src = fwtset.preferred.path
+        for f in fwtset.files:
+            if f.path.samefile(src):
+                continue
+            tmp_path = f.path.with_name(f".{f.path.name}.fwtlink")
+            try:
+                os.link(src,tmp_path)
+            except OSError as e:
+                logging.warning(f"can't hard link {f.path} to {src}: {e}")
+                continue
+            os.replace(tmp_path,f.path)
+            self.reclaimed += size
+
+    def process_rewrite_queue(self,quote_find=False):
+        """rewrite the databases of every project"""
+        if not self.rewrite_queue:
+            return
+        errors = []
+        for project in self.projects:
+            project.jobs = self.jobs
+            try:
+                project.db_replace(batch=self.rewrite_queue,
+                                   quote_find=quote_find)
+            except FWTFileError as e:
+                errors.append(str(e))
+        if errors:
+            raise FWTFileError("\n".join(errors))
+
 class FWTPath(_Path_):
     """
     interface for representing paths in foundry assets.
@@ -546,9 +1353,20 @@ class FWTPath(_Path_):
 
 
 
+    def _derive(self,rtp):
+        """
+        Return a FWTPath for rtp in the same foundry user dir and project
+        using the values already resolved for this path
+        """
+        path = FWTPath.__new__(FWTPath,self._fwt_fud / rtp)
+        path.__dict__.update(self.__dict__)
+        path.orig_path = path.as_posix()
+        path._fwt_rtp = _Path_(rtp)
+        return path
+
     def is_project_dir(self):
         if self.is_project:
-            return self.as_fpd() == self.as_ftp()
+            return self._fwt_rpd == self._fwt_rtp
 
     def as_rpd(self):
         return self._fwt_rpd.as_posix()
@@ -563,19 +1381,19 @@ class FWTPath(_Path_):
         return self._fwt_rtp
 
     def to_fpd(self):
-        return FWTPath(self._fwt_fud / self._fwt_rpd)
+        return self._derive(self._fwt_rpd)
 
     def as_fpd(self):
-        return self.to_fpd().as_posix()
+        return (self._fwt_fud / self._fwt_rpd).as_posix()
 
     def to_ftp(self):
-        return FWTPath(self._fwt_fud / self._fwt_rtp)
+        return self._derive(self._fwt_rtp)
 
     def as_ftp(self):
-        return self.to_ftp().as_posix()
+        return (self._fwt_fud / self._fwt_rtp).as_posix()
     
     def as_rpp(self):
-        return self.to_ftp().relative_to(self.to_fpd()).as_posix()
+        return self._fwt_rtp.relative_to(self._fwt_rpd).as_posix()
 
     def iterdir(self):
         return map(FWTPath, super().iterdir())
@@ -588,7 +1406,7 @@ class FWTFile:
     """interface for changing files"""
 
     def __init__(self, path, trash_dir=None, keep_src=False):
-        self.path = FWTPath(path)        
+        self.path = path
         self.new_path = False
         self.trash_path = False
         self.locked = False
@@ -608,7 +1426,7 @@ class FWTFile:
 
     @path.setter
     def path(self,path):
-        self.__path = FWTPath(path)
+        self.__path = path if isinstance(path,FWTPath) else FWTPath(path)
 
     @property
     def new_path(self):
@@ -648,14 +1466,16 @@ class FWTFile:
             return True
         return False
 
-    def copy(self, overwrite=False):
+    def copy(self, overwrite=False, link_mode="copy", stats=None):
         if not self.new_path:
             return False
         if self.new_path.exists() and not overwrite:
             raise FWTPathError(
                 f"Can't copy file {self.path}\nTarget {self.new_path} exists!")
         os.makedirs(self.new_path.parent, exist_ok=True)
-        shutil.copy2(self.path, self.new_path)
+        if self.new_path.exists():
+            self.new_path.unlink()
+        copy_file(self.path, self.new_path, link_mode, stats)
         self.copy_of = self.path
         self.path = self.new_path
         self.new_path = False
@@ -779,19 +1599,55 @@ class FWTSet:
         files = "\n".join([str(f) for f in self._files])
         return f"id:{self.id}\npreferred:{self.preferred}\nfiles:\n{files}"
 
+def glob_to_regex(pattern):
+    """
+    translate a pathlib.match style pattern into a regex matched against
+    the end of a posix path, or all of it when the pattern is absolute.
+    Wildcards don't match across path separators.
+    """
+    parts = []
+    for part in pattern.rstrip('/').split('/'):
+        out = []
+        i = 0
+        while i < len(part):
+            c = part[i]
+            j = part.find(']',i + 2) if c == '[' else -1
+            if c == '*':
+                out.append('[^/]*')
+            elif c == '?':
+                out.append('[^/]')
+            elif j != -1:
+                body = part[i+1:j].replace('\\','\\\\')
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                out.append(f'[{body}]')
+                i = j
+            else:
+                out.append(re.escape(c))
+            i += 1
+        parts.append(''.join(out))
+    regex = '/'.join(parts)
+    if pattern.startswith('/'):
+        return f'^{regex}$'
+    return f'(?:^|/){regex}$'
+
 class FWTFilter:
     chain_type = None
     plugin_type = None
-    _matches = []
 
     def __init__(self,exclude=False):
         self.exclude = exclude
+        self._matches = []
 
     def _filter(self,p):
         raise NotImplementedError
 
     def _process(self,p):
         raise NotImplementedError   
+
+    def match_entry(self,entry):
+        """filter an os.DirEntry, returns True to keep it"""
+        return bool(self(_Path_(entry.path)))
     
     def __call__(self,p):
         if self.chain_type == "filter":
@@ -822,15 +1678,14 @@ class FileExtensionsFilter(FWTFilter):
     def add_match(self,m):
         if m[0] != '.': m = '.'+m
         self._matches.append(m)
+        self.extensions = frozenset(m.lower() for m in self._matches)
     def _filter(self,p):
-        e = p.suffix.lower()
-        for m in self._matches:
-            m = m.lower()
-            if self.exclude:
-                if e == m: continue 
-            else:
-                if e == m: return p
+        if (p.suffix.lower() in self.extensions) != self.exclude:
+            return p
         return False
+    def match_entry(self,entry):
+        e = os.path.splitext(entry.name)[1].lower()
+        return (e in self.extensions) != self.exclude
 
 class DirNamesFilter(FWTFilter):
     """project relative dir match. See pathlib.match"""
@@ -838,17 +1693,24 @@ class DirNamesFilter(FWTFilter):
     plugin_type = 'dir'
     def __init__(self,exclude=True):
         self.exclude = exclude
+        self._matches = []
     def add_match(self,m):
         self._matches.append(m)
+        flags = re.IGNORECASE if os.name == 'nt' else 0
+        self.regex = re.compile(
+            '|'.join(glob_to_regex(Path(m).as_posix()) for m in self._matches),
+            flags)
     def _filter(self,p):
-        for m in self._matches:
+        return self.match_entry(p) and p
+    def match_entry(self,entry):
+        path = os.fspath(entry)
+        if os.sep != '/':
+            path = path.replace(os.sep,'/')
+        if self.regex.search(path):
             if self.exclude:
-                if p.match(m):
-                    logging.debug(f"DirNamesFilter: exclude matched {p}")
-                    return False
-            else:
-                if p.match(m): return p
-        return p if self.exclude else False
+                logging.debug(f"DirNamesFilter: exclude matched {path}")
+            return not self.exclude
+        return self.exclude
 
 class FWTChain:
     def __init__(self):
@@ -889,37 +1751,60 @@ class FWTChain:
         raise NotImplementedError
 
 class FWTScan(FWTChain):
+    """
+    Walks a directory tree using os.scandir. Directories removed by the dir
+    filters are not descended into and FWTPath objects are only created for
+    files which pass the file filters. When root is a FWTPath the paths of
+    files are derived from it instead of being resolved again, except below
+    a directory holding another project.
+    """
     def __init__(self,root):
         super().__init__()
         self._root = root
-        self._dir_cb = self._walk
 
-    def _walk(self,p):
-        for p in p.iterdir():
-            if p.is_dir():
-                yield from self._dir_filter(p)
-            else:
-                yield from self._file_filter(p)
+    def _walk(self,path,derive=None):
+        with os.scandir(path) as it:
+            entries = list(it)
+        if derive and path != self._top and any(
+                e.name in FWTPath.project_manafests for e in entries):
+            derive = None
+        for entry in entries:
+            if entry.is_dir():
+                if all(f.match_entry(entry) for f in self._dir_filter_chain):
+                    yield from self._walk(entry.path,derive)
+            elif all(f.match_entry(entry) for f in self._file_filter_chain):
+                path = derive(entry.path) if derive else FWTPath(entry.path)
+                yield from self._file_processor(path)
 
     def __iter__(self):
-        return self._walk(self._root) 
+        root = self._root
+        derive = None
+        if isinstance(root,FWTPath) and root.as_ftp() == root.as_posix():
+            prefix = len(root.as_posix())
+            rtp = root.as_rtp()
+            derive = lambda p: root._derive(rtp + p[prefix:])
+        self._top = root.as_posix() if derive else root
+        return self._walk(self._top,derive)
 
 class FWTFileWriter(AbstractContextManager):
     def __init__(self,*args,**kwargs):
         self.__read_fd = False
         self._trash_overwrite = True
         self._trash_dir = False
+        self._allow_empty = False
         self.setup(*args,**kwargs)
 
     def setup(self,dest_path=None,trash_dir=None,read_fd=None,
-              trash_overwrite=None):
+              trash_overwrite=None,allow_empty=None):
         if read_fd != None:
             self.__read_fd = read_fd
+        if allow_empty != None:
+            # replace the file even when nothing was written
+            self._allow_empty = allow_empty
         if trash_overwrite != None:
             self._trash_overwrite = trash_overwrite
         if trash_dir != None:
             self._trash_dir = _Path_(trash_dir)
-            self._trash_dir.parent.mkdir(parents=True,exist_ok=True)
         if dest_path:
             self._dest_path = Path(dest_path)
             self._temp_path = self._dest_path.with_suffix('.part')
@@ -930,11 +1815,16 @@ class FWTFileWriter(AbstractContextManager):
     def _open_write_fd(self):
         return self._temp_path.open("w+t",encoding="utf-8")
 
-    def __exit__(self,*args):
+    def __exit__(self,exc_type,*args):
         if self.__read_fd:
             self.read_fd.close()
+        if exc_type:
+            # leave the original in place when the rewrite failed
+            self.write_fd.close()
+            self._temp_path.unlink()
+            return
         self.write_fd.flush()
-        if self.write_fd.tell() == 0:
+        if self.write_fd.tell() == 0 and not self._allow_empty:
             self.write_fd.close()
             self._temp_path.unlink()
             return
@@ -967,6 +1857,155 @@ class FWTFileWriter(AbstractContextManager):
         return self
 
 
+class FWTHashCache:
+    """
+    A SQLite store of file hashes. Entries are keyed by file path and kind
+    of hash and are only used while the inode, size and mtime of the file
+    are unchanged. Entries not used within max_age seconds are evicted
+    and the least recently used entries are evicted beyond max_entries.
+    """
+    def __init__(self,cache_file,max_age=90*24*60*60,max_entries=1000000):
+        self.cache_file = Path(cache_file)
+        self.cache_file.parent.mkdir(parents=True,exist_ok=True)
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._db = sqlite3.connect(self.cache_file,timeout=SQLITE_TIMEOUT)
+        self._committed = time.time()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS hashes (path TEXT, kind TEXT,"
+            " inode INTEGER, size INTEGER, mtime_ns INTEGER, digest TEXT,"
+            " used REAL, PRIMARY KEY (path,kind))")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used)")
+        logging.debug(f"FWTHashCache: opened {self.cache_file}")
+
+    def get(self,path,st,kind):
+        path = Path(path).as_posix()
+        row = self._db.execute(
+            "SELECT inode,size,mtime_ns,digest FROM hashes"
+            " WHERE path=? AND kind=?",(path,kind)).fetchone()
+        if not row:
+            return None
+        if row[:3] != (st.st_ino,st.st_size,st.st_mtime_ns):
+            logging.debug(f"FWTHashCache: invalidated {kind} hash of {path}")
+            self.invalidate(path)
+            return None
+        self._db.execute("UPDATE hashes SET used=? WHERE path=? AND kind=?",
+            (time.time(),path,kind))
+        self._checkpoint()
+        return row[3]
+
+    def put(self,path,st,kind,digest):
+        self._db.execute(
+            "INSERT OR REPLACE INTO hashes VALUES (?,?,?,?,?,?,?)",
+            (Path(path).as_posix(),kind,st.st_ino,st.st_size,
+             st.st_mtime_ns,digest,time.time()))
+        self._checkpoint()
+
+    def _checkpoint(self):
+        """commit every second so other processes aren't locked out"""
+        if time.time() - self._committed > 1:
+            self._db.commit()
+            self._committed = time.time()
+
+    def invalidate(self,path):
+        self._db.execute("DELETE FROM hashes WHERE path=?",
+            (Path(path).as_posix(),))
+
+    def evict(self):
+        self._db.execute("DELETE FROM hashes WHERE used < ?",
+            (time.time() - self.max_age,))
+        self._db.execute(
+            "DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes"
+            " ORDER BY used DESC LIMIT -1 OFFSET ?)",(self.max_entries,))
+
+    def commit(self):
+        self.evict()
+        self._db.commit()
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+class FWTDownloadCache:
+    """
+    A cache of downloaded files. The ETag and Last-Modified values of each
+    URL are kept with the hash of its content so later downloads can be
+    conditional requests. Contents are stored once per hash and hard
+    linked, or copied across devices, to where they are needed.
+    """
+    def __init__(self,cache_dir):
+        self.cache_dir = Path(cache_dir)
+        (self.cache_dir / "objects").mkdir(parents=True,exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.cache_dir / "index.sqlite",
+                                   timeout=SQLITE_TIMEOUT,
+                                   check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY,"
+            " etag TEXT, last_modified TEXT, digest TEXT, used REAL)")
+        logging.debug(f"FWTDownloadCache: opened {self.cache_dir}")
+
+    def object_path(self,digest):
+        return self.cache_dir / "objects" / digest[:2] / digest
+
+    def lookup(self,url):
+        """
+        Return the request headers for a conditional download of url and
+        the digest of the cached content, or ({},None) if it isn't cached
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT etag,last_modified,digest FROM urls WHERE url=?",
+                (url,)).fetchone()
+        if not row or not self.object_path(row[2]).exists():
+            return {},None
+        etag,last_modified,digest = row
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers,digest
+
+    def store(self,url,file_path,digest,etag=None,last_modified=None):
+        """
+        move the file downloaded from url, with content hash digest, into
+        the cache and return the digest
+        """
+        obj = self.object_path(digest)
+        if obj.exists():
+            os.unlink(file_path)
+        else:
+            obj.parent.mkdir(parents=True,exist_ok=True)
+            temp_path = obj.with_suffix(f".{threading.get_ident()}.part")
+            shutil.move(file_path,temp_path)
+            temp_path.replace(obj)
+        self.update(url,digest,etag,last_modified)
+        return digest
+
+    def update(self,url,digest,etag=None,last_modified=None):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO urls VALUES (?,?,?,?,?)",
+                (url,etag,last_modified,digest,time.time()))
+
+    def link(self,digest,path):
+        """place the cached content with digest at path"""
+        path = Path(path)
+        obj = self.object_path(digest)
+        if path.exists():
+            path.unlink()
+        try:
+            os.link(obj,path)
+        except OSError:
+            shutil.copyfile(obj,path)
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
 class FWTProjectDb:
     def __init__(self,project_dir,driver,trash_dir='trash'):
         self.project_dir = FWTPath(project_dir,require_project=True)
@@ -991,8 +2030,8 @@ class FWTDb:
         self.file_context = FWTFileWriter(trash_dir=trash_dir,trash_overwrite=False)
         self._data_file = Path(data_file)
 
-    def writer(self):
-        return self.file_context(dest_path=self.path)
+    def writer(self,allow_empty=False):
+        return self.file_context(dest_path=self.path,allow_empty=allow_empty)
 
     @property
     def path(self):
@@ -1010,11 +2049,19 @@ class FWTTextDb(FWTDb):
         return (line for i,line in enumerate(open(self.path,'r+t')))
 
 class FWTNeDB(FWTDb):
-    """A lightweight object to manage reading and writing NeDB files"""
+    """
+    A lightweight object to manage reading and writing NeDB files. Documents
+    are looked up by _id through the ids map, which holds the position of
+    the last version of each document that wasn't deleted. find and update
+    take NeDB style queries of dotted field names and values and only see
+    those versions. ensure_index builds a hash index for a field which find
+    and update use instead of scanning every document.
+    """
     def __init__(self,data_file,*args,**kwargs):
         super().__init__(data_file,*args,**kwargs)
         self._data = []
         self._ids = {}
+        self._indexes = {}
 
     @property
     def ids(self):
@@ -1024,37 +2071,209 @@ class FWTNeDB(FWTDb):
         n = "".join(random.choices(string.ascii_letters + string.digits,k=16))
         return n
 
-    def find(self,query,projection=None):
-        raise NotImplementedError
+    def ensure_index(self,field):
+        """build a hash index of the values of field, a dotted field name"""
+        if not self._data:
+            self.load()
+        if field in self._indexes:
+            return
+        index = {}
+        for i in self._ids.values():
+            index.setdefault(index_key(get_field(self._data[i],field)),set()).add(i)
+        self._indexes[field] = index
+
+    def remove_index(self,field):
+        self._indexes.pop(field,None)
+
+    def _candidates(self,query):
+        """return the positions of the documents which may match query"""
+        if "_id" in query:
+            i = self._ids.get(query["_id"])
+            return [] if i is None else [i]
+        found = None
+        for field,value in query.items():
+            if field in self._indexes:
+                positions = self._indexes[field].get(index_key(value),set())
+                found = positions if found is None else found & positions
+        if found is None:
+            return sorted(self._ids.values())
+        return sorted(found)
+
+    def _match(self,query):
+        """yield the position and document of each match for query"""
+        if not self._data:
+            self.load()
+        for i in self._candidates(query):
+            doc = self._data[i]
+            if all(get_field(doc,field) == value
+                   for field,value in query.items()):
+                yield i,doc
 
-    def update(self,query,update,options):
-        raise NotImplementedError
+    def find(self,query,projection=None):
+        """
+        return the documents where every dotted field name in query has the
+        given value. projection is a dict of fields to include, {field: 1},
+        or to leave out, {field: 0}.
+        """
+        docs = [doc for _,doc in self._match(query)]
+        if projection:
+            docs = [project_fields(doc,projection) for doc in docs]
+        return docs
+
+    def update(self,query,update,options=None):
+        """
+        update the documents matching query and return the number updated.
+        update either replaces the document or uses the $set and $unset
+        operators with dotted field names. options are multi, to update
+        every match instead of the first, and upsert, to insert a document
+        when nothing matches.
+        """
+        options = options or {}
+        matches = self._match(query)
+        matches = list(matches if options.get("multi") else islice(matches,1))
+        for i,doc in matches:
+            self._unindex(i,doc)
+            try:
+                new_doc = apply_update(doc,update)
+                new_doc["_id"] = doc["_id"]
+                self._data[i] = new_doc
+            finally:
+                self._index(i,self._data[i])
+        if not matches and options.get("upsert"):
+            doc = apply_update({k:v for k,v in query.items() if "." not in k},update)
+            doc.setdefault("_id",self.genId())
+            self.insert(doc)
+            return 1
+        return len(matches)
+
+    def insert(self,doc):
+        if doc["_id"] in self._ids:
+            raise ValueError(f"Document with _id {doc['_id']} already exists")
+        self._data.append(doc)
+        self._index(len(self._data) - 1,doc)
+        return doc
+
+    def _index(self,i,doc):
+        self._ids[doc["_id"]] = i
+        for field,index in self._indexes.items():
+            index.setdefault(index_key(get_field(doc,field)),set()).add(i)
+
+    def _unindex(self,i,doc):
+        self._ids.pop(doc["_id"],None)
+        for field,index in self._indexes.items():
+            index.get(index_key(get_field(doc,field)),set()).discard(i)
 
     def find_generator(self, lookup_val, lookup_key="_id", lookup_obj=None):
-        if lookup_obj == None: lookup_obj = self._data
+        if lookup_obj is None: lookup_obj = self._data
         if isinstance(lookup_obj, dict):
             logging.debug("obj_lookup_generater: found dict object")
             for k, v in lookup_obj.items():
                 if k == lookup_key and (v == lookup_val or lookup_val == "*"):
                     yield lookup_obj
-                else:
-                    yield from self.find_generator(v, lookup_val, lookup_key)
+                elif isinstance(v, (dict, list)):
+                    yield from self.find_generator(lookup_val, lookup_key, v)
         elif isinstance(lookup_obj, list):
             logging.debug("obj_lookup_generator: found list object")
             for item in lookup_obj:
-                yield from self.find_generator(item, lookup_val, lookup_key)
+                yield from self.find_generator(lookup_val, lookup_key, item)
         else:
             logging.debug("obj_lookup_generator: got unknown object")
 
+    def stream(self):
+        """
+        yield the documents in the database file one at a time without
+        loading the whole file
+        """
+        with open(self.path,'r',encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield nedb_loads(line)
+
+    def transform(self,func,append=()):
+        """
+        rewrite the database file one document at a time. func is called
+        with each document and returns the document to write, or None to
+        remove it. The documents in append are written at the end. Returns
+        the number of documents written.
+        """
+        written = 0
+        with self.writer(allow_empty=True) as f:
+            writer = jsonlines.Writer(f.write_fd,dumps=nedb_dumps)
+            for doc in chain((func(doc) for doc in self.stream()),append):
+                if doc is not None:
+                    writer.write(doc)
+                    written += 1
+        self._data = []
+        self._ids = {}
+        return written
+
+    def replace_documents(self,docs):
+        """
+        rewrite the database with docs, a dict of the documents to write
+        instead of the ones at those positions in the file
+        """
+        position = count()
+        return self.transform(lambda doc: docs.get(next(position),doc))
+
+    def compact(self):
+        """
+        rewrite the database keeping only the last version of each document
+        and dropping deleted documents, as NeDB does when it compacts a
+        datafile. Index definitions are kept at the end of the file. Lines
+        without an _id are logged and kept as they are. Returns the file
+        size before and after.
+        """
+        last = {}
+        indexes = {}
+        other = []
+        lines = 0
+        for i,doc in enumerate(self.stream()):
+            lines += 1
+            if "$$indexCreated" in doc:
+                indexes[doc["$$indexCreated"]["fieldName"]] = doc
+            elif "$$indexRemoved" in doc:
+                indexes.pop(doc["$$indexRemoved"],None)
+            elif "_id" not in doc:
+                logging.warning(f"{self.path}: line {i + 1} has no _id,"
+                                " keeping it")
+                other.append(i)
+            elif doc.get("$$deleted"):
+                last.pop(doc["_id"],None)
+            else:
+                last[doc["_id"]] = i
+        size = os.stat(self.path).st_size
+        if lines == len(last) + len(indexes) + len(other):
+            return size,size
+        keep = set(last.values()).union(other)
+        position = count()
+        self.transform(lambda doc: doc if next(position) in keep else None,
+                       append=indexes.values())
+        return size,os.stat(self.path).st_size
+
     def load(self):
-        with open(self.path,'r') as f:
-            self._data = [json.loads(x) for x in f.readlines()]
-        for i,obj in enumerate(self._data,start=0):
-            self._ids.update({obj["_id"]:i})
+        """
+        read every line of the database file, so save writes them all back,
+        and index the last version of each document that wasn't deleted.
+        Lines without an _id other than index definitions are logged.
+        """
+        self._data = list(self.stream())
+        self._ids = {}
+        for i,doc in enumerate(self._data):
+            if "_id" not in doc:
+                if "$$indexCreated" not in doc and "$$indexRemoved" not in doc:
+                    logging.warning(f"{self.path}: line {i + 1} has no _id,"
+                                    " ignoring it")
+            elif doc.get("$$deleted"):
+                self._ids.pop(doc["_id"],None)
+            else:
+                self._ids[doc["_id"]] = i
+        fields,self._indexes = list(self._indexes),{}
+        for field in fields:
+            self.ensure_index(field)
 
     def save(self):
         with self.writer() as f:
-            writer = jsonlines.Writer(f.write_fd,compact=True,sort_keys=True)
+            writer = jsonlines.Writer(f.write_fd,dumps=nedb_dumps)
             writer.write_all(self._data)
 
     def __getitem__(self,key):
@@ -1067,22 +2286,499 @@ class FWTNeDB(FWTDb):
             self.load()
         return self._data.__iter__()
 
+_MISSING = object()
+_nedb_encoder = json.JSONEncoder(ensure_ascii=False,separators=(",",":"),
+                                 sort_keys=True)
+
+_digits = str.maketrans("123456789","000000000")
+_long_number = "0" * 19
+
+def nedb_loads(line):
+    """
+    parse one NeDB document, using orjson when it is installed. orjson
+    reads integers too large for 64 bits as floats so lines which may
+    contain them are parsed with json.
+    """
+    if orjson and _long_number not in line.translate(_digits):
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(line)
+
+def nedb_dumps(doc):
+    """
+    serialize one NeDB document with sorted keys and no whitespace, using
+    orjson when it is installed
+    """
+    if orjson:
+        try:
+            return orjson.dumps(doc,option=orjson.OPT_SORT_KEYS).decode()
+        except orjson.JSONEncodeError:
+            pass
+    return _nedb_encoder.encode(doc)
+
+def get_field(doc,field):
+    """return the value of a dotted field name in doc"""
+    value = doc
+    for key in field.split("."):
+        if not isinstance(value,dict) or key not in value:
+            return _MISSING
+        value = value[key]
+    return value
+
+def index_key(value):
+    """return a hashable key for a document value"""
+    if isinstance(value,(dict,list)):
+        return json.dumps(value,sort_keys=True)
+    return value
+
+def project_fields(doc,projection):
+    """return a copy of doc with the fields selected by projection"""
+    include = [f for f,v in projection.items() if v]
+    exclude = [f for f,v in projection.items() if not v]
+    if include and exclude and exclude != ["_id"]:
+        raise ValueError("projection can't both include and exclude fields")
+    if include:
+        result = {"_id":doc["_id"]}
+        for field in include:
+            value = get_field(doc,field)
+            if value is not _MISSING:
+                set_field(result,field,value)
+    else:
+        result = json.loads(json.dumps(doc))
+    for field in exclude:
+        unset_field(result,field)
+    return result
+
+def set_field(doc,field,value):
+    """set a dotted field name in doc, adding any missing objects"""
+    *parents,key = field.split(".")
+    for parent in parents:
+        doc = doc.setdefault(parent,{})
+        if not isinstance(doc,dict):
+            raise ValueError(f"Can't set {field}, {parent} is not an object")
+    doc[key] = value
+
+def unset_field(doc,field):
+    *parents,key = field.split(".")
+    for parent in parents:
+        doc = doc.get(parent)
+        if not isinstance(doc,dict):
+            return
+    doc.pop(key,None)
+
+def apply_update(doc,update):
+    """
+    apply an NeDB style update to doc and return the document. Operators
+    change doc in place, an update without operators is a new document.
+    """
+    operators = [k for k in update if k.startswith("$")]
+    if not operators:
+        return dict(update)
+    if len(operators) != len(update):
+        raise ValueError("update can't mix operators and fields")
+    for op in operators:
+        if op not in ("$set","$unset"):
+            raise ValueError(f"Unsupported update operator {op}")
+    for op,fields in update.items():
+        if op == "$set":
+            for field,value in fields.items():
+                set_field(doc,field,value)
+        elif op == "$unset":
+            for field in fields:
+                unset_field(doc,field)
+    return doc
+
+class FWTRefIndex:
+    """
+    A SQLite index of the asset paths referenced by a project. Each
+    reference is stored with the database, document _id and dotted field
+    name which uses it. The manifest has an empty _id. Paths are stored as
+    normalized by normalize_ref. refresh only reads the databases whose
+    mtime or size changed since they were indexed.
+    """
+    def __init__(self,index_file,project_dir):
+        self.index_file = Path(index_file)
+        self.index_file.parent.mkdir(parents=True,exist_ok=True)
+        self.project_dir = FWTPath(project_dir,require_project=True).to_fpd()
+        self._project = self.project_dir.as_posix()
+        self._db = sqlite3.connect(self.index_file,timeout=SQLITE_TIMEOUT)
+        version, = self._db.execute("PRAGMA user_version").fetchone()
+        if version != REF_INDEX_VERSION:
+            # paths were stored differently, index everything again
+            with self._db:
+                self._db.execute("DROP TABLE IF EXISTS dbs")
+                self._db.execute("DROP TABLE IF EXISTS refs")
+                self._db.execute(f"PRAGMA user_version = {REF_INDEX_VERSION}")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS dbs (db TEXT PRIMARY KEY,"
+            " project TEXT, mtime_ns INTEGER, size INTEGER)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS refs (project TEXT, asset TEXT,"
+            " db TEXT, id TEXT, field TEXT)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS refs_asset ON refs (project,asset)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS refs_db ON refs (db)")
+        logging.debug(f"FWTRefIndex: opened {self.index_file}")
+
+    @property
+    def db_files(self):
+        return [Path(self.project_dir.manafest),
+                *sorted(self.project_dir.glob("data/*.db")),
+                *sorted(self.project_dir.glob("packs/*.db"))]
+
+    def refresh(self):
+        """index the databases that changed, returns the number read"""
+        known = {db:(mtime_ns,size) for db,mtime_ns,size in self._db.execute(
+            "SELECT db,mtime_ns,size FROM dbs WHERE project=?",
+            (self._project,))}
+        scanned = 0
+        for db_file in self.db_files:
+            st = db_file.stat()
+            db = db_file.as_posix()
+            if known.pop(db,None) == (st.st_mtime_ns,st.st_size):
+                continue
+            logging.debug(f"FWTRefIndex: indexing {db}")
+            # read the database before locking the index for other processes
+            refs = [(self._project,asset,db,_id,field)
+                    for _id,field,asset in self._scan(db_file)]
+            with self._db:
+                self._remove(db)
+                self._db.executemany("INSERT INTO refs VALUES (?,?,?,?,?)",refs)
+                self._db.execute("INSERT INTO dbs VALUES (?,?,?,?)",
+                    (db,self._project,st.st_mtime_ns,st.st_size))
+            scanned += 1
+        with self._db:
+            for db in known:
+                self._remove(db)
+        return scanned
+
+    def _remove(self,db):
+        self._db.execute("DELETE FROM refs WHERE db=?",(db,))
+        self._db.execute("DELETE FROM dbs WHERE db=?",(db,))
+
+    def _scan(self,db_file):
+        """yield (_id,field,asset) for the current documents of db_file"""
+        if db_file.suffix != ".db":
+            with open(db_file,'r',encoding='utf-8') as f:
+                for field,asset in asset_refs(json.load(f)):
+                    yield "",field,asset
+            return
+        docs = {}
+        for doc in FWTNeDB(db_file).stream():
+            if "_id" not in doc:
+                continue
+            if doc.get("$$deleted"):
+                docs.pop(doc["_id"],None)
+            else:
+                docs[doc["_id"]] = list(asset_refs(doc))
+        for _id,refs in docs.items():
+            for field,asset in refs:
+                yield _id,field,asset
+
+    def find(self,asset):
+        """return (db,_id,field) for each reference to asset"""
+        return self._db.execute(
+            "SELECT db,id,field FROM refs WHERE project=? AND asset=?",
+            (self._project,asset)).fetchall()
+
+    def assets(self,prefix=""):
+        """return the referenced asset paths which start with prefix"""
+        if not prefix:
+            query = ("SELECT DISTINCT asset FROM refs WHERE project=?",
+                     (self._project,))
+        else:
+            end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            query = ("SELECT DISTINCT asset FROM refs WHERE project=?"
+                     " AND asset >= ? AND asset < ?",
+                     (self._project,prefix,end))
+        return [asset for asset, in self._db.execute(*query)]
+
+    def dbs_referencing(self,assets):
+        """return the paths of the files which reference any of assets"""
+        assets = list(assets)
+        dbs = set()
+        for i in range(0,len(assets),500):
+            chunk = assets[i:i + 500]
+            dbs.update(db for db, in self._db.execute(
+                "SELECT DISTINCT db FROM refs WHERE project=? AND asset IN"
+                f" ({','.join('?' * len(chunk))})",(self._project,*chunk)))
+        return [Path(db) for db in sorted(dbs)]
+
+    def _classify(self):
+        """
+        yield (asset,found) for each referenced asset, where found is None
+        when the reference can't be checked because it doesn't start with
+        a top level directory of the foundry user dir. Each directory is
+        listed once.
+        """
+        fud = self.project_dir._fwt_fud
+        listings = {}
+        def listing(d):
+            if d not in listings:
+                try:
+                    listings[d] = set(os.listdir(fud / d))
+                except (FileNotFoundError,NotADirectoryError):
+                    listings[d] = set()
+            return listings[d]
+        top = {e for e in listing("") if (fud / e).is_dir()}
+        for asset in self.assets():
+            paths = [p for p in dict.fromkeys((asset,normalize_ref(asset)))
+                     if p.split("/")[0] in top]
+            if not paths:
+                yield asset,None
+                continue
+            for path in paths:
+                d,_,name = path.rpartition("/")
+                if name in listing(d):
+                    yield asset,True
+                    break
+            else:
+                yield asset,False
+
+    def missing(self):
+        """
+        return (db,_id,field,asset) for each reference to a file that
+        doesn't exist. References are normalized before they are checked,
+        those which can't be checked are returned by unchecked.
+        """
+        missing = []
+        for asset,found in self._classify():
+            if found is False:
+                missing.extend((db,_id,field,asset)
+                               for db,_id,field in self.find(asset))
+        return sorted(missing)
+
+    def unchecked(self):
+        """
+        return (db,_id,field,asset) for each reference outside of the top
+        level directories of the foundry user dir, such as the icons
+        provided by Foundry, which can't be checked.
+        """
+        unchecked = []
+        for asset,found in self._classify():
+            if found is None:
+                unchecked.extend((db,_id,field,asset)
+                                 for db,_id,field in self.find(asset))
+        return sorted(unchecked)
+
+    def close(self):
+        self._db.close()
+
+_asset_path = re.compile(
+    r'(?![A-Za-z][\w+.-]*:)[^<>"|\r\n]*/[^<>"|\r\n/]*\.[A-Za-z][A-Za-z0-9]{1,4}')
+# a cheap test for the end of a path, every value holding a path matches it
+_asset_path_end = re.compile(r'/[^<>"|\r\n/]*\.[A-Za-z]')
+_embedded_refs = re.compile(
+    r'(?:src|href)\s*=\s*(["\'])(.+?)\1|url\(\s*(["\']?)(.+?)\3\s*\)'
+    r'|([^\s"\'<>(),]+/[^\s"\'<>(),]+)')
+_text_nodes = re.compile(r'>\s*([^<>]+?)\s*<')
+# text which is more than one path: words before the first "/", a list
+# of paths, or a file name followed by more text
+_not_bare_path = re.compile(r'^[^/]*\s|[,;]\s|\.[A-Za-z][A-Za-z0-9]{1,4}\s')
+
+def is_bare_path(text):
+    """True when text is a single asset path and nothing else"""
+    return (_asset_path.fullmatch(text) is not None
+            and not _not_bare_path.search(text))
+
+def normalize_ref(path):
+    """
+    return the path of the file used by a reference, without a leading
+    "/", query string or fragment and with %-escapes decoded
+    """
+    path = path.split("#",1)[0].split("?",1)[0]
+    if path.startswith("/") and not path.startswith("//"):
+        path = path[1:]
+    return urllib.parse.unquote(path)
+
+def asset_refs(obj,field=None):
+    """
+    yield (field,path) for each asset path referenced in a document, where
+    field is the dotted name of the value. A value may be a path, or text
+    such as HTML which contains paths. Keys which are paths, as modules use
+    in flags, are referenced too. Paths are normalized with normalize_ref.
+    """
+    stack = [(obj,field)]
+    while stack:
+        obj,field = stack.pop()
+        items = obj.items() if type(obj) is dict else enumerate(obj)
+        prefix = "" if field is None else field + "."
+        for key,value in items:
+            if type(key) is str and _asset_path_end.search(key):
+                path = normalize_ref(key)
+                if is_bare_path(path):
+                    yield f"{prefix}{key}",path
+            if type(value) is str:
+                if not _asset_path_end.search(value):
+                    continue
+                path = normalize_ref(value)
+                if is_bare_path(path):
+                    yield f"{prefix}{key}",path
+                    continue
+                paths = set()
+                for match in _embedded_refs.finditer(value):
+                    path = normalize_ref(match[2] or match[4] or match[5])
+                    if path not in paths and _asset_path.fullmatch(path):
+                        paths.add(path)
+                        yield f"{prefix}{key}",path
+                # paths with spaces in the text of an element
+                for match in _text_nodes.finditer(value):
+                    path = normalize_ref(match[1])
+                    if path not in paths and is_bare_path(path):
+                        paths.add(path)
+                        yield f"{prefix}{key}",path
+            elif type(value) is dict or type(value) is list:
+                stack.append((value,f"{prefix}{key}"))
+
+class FWTHttpClient:
+    """
+    A small HTTP client for use from several threads. Each thread keeps one
+    keep-alive connection per host. host_rate limits how many requests per
+    second are started for a single host.
+    """
+    def __init__(self,agent_string,timeout=60,host_rate=None,max_redirects=5):
+        self.agent_string = agent_string
+        self.timeout = timeout
+        self.host_rate = host_rate
+        self.max_redirects = max_redirects
+        self._local = threading.local()
+        self._rate_lock = threading.Lock()
+        self._next_request = {}
+        self._open = []
+
+    def _wait_for_host(self,host):
+        if not self.host_rate:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            start = max(now,self._next_request.get(host,now))
+            self._next_request[host] = start + 1 / self.host_rate
+        if start > now:
+            time.sleep(start - now)
+
+    def _drop(self,scheme,netloc):
+        """close and forget the current thread's connection to a host"""
+        conn = self._local.__dict__.get('conns',{}).pop((scheme,netloc),None)
+        if conn:
+            conn.close()
+
+    def _connection(self,scheme,netloc,new=False):
+        conns = self._local.__dict__.setdefault('conns',{})
+        conn = conns.get((scheme,netloc))
+        if new and conn:
+            conn.close()
+            conn = None
+        if not conn:
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(netloc,timeout=self.timeout)
+            elif scheme == 'http':
+                conn = http.client.HTTPConnection(netloc,timeout=self.timeout)
+            else:
+                raise ValueError(f"unsupported URL scheme {scheme}")
+            conns[(scheme,netloc)] = conn
+            with self._rate_lock:
+                self._open.append(conn)
+        return conn
+
+    def request(self,method,url,headers=None):
+        """
+        Send a request following redirects and return the
+        http.client.HTTPResponse. The response must be read to the end or
+        closed before the thread makes another request.
+        """
+        for _ in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            target = urllib.parse.urlunsplit(('','',parts.path or '/',parts.query,''))
+            send_headers = {'User-Agent':self.agent_string,**(headers or {})}
+            self._wait_for_host(parts.netloc)
+            for retry in (False,True):
+                conn = self._connection(parts.scheme,parts.netloc,new=retry)
+                try:
+                    conn.request(method,target,headers=send_headers)
+                    resp = conn.getresponse()
+                    break
+                except (http.client.RemoteDisconnected,ConnectionResetError,
+                        BrokenPipeError,http.client.ImproperConnectionState):
+                    # the server closed a kept alive connection or the last
+                    # response on it wasn't read to the end
+                    if retry:
+                        self._drop(parts.scheme,parts.netloc)
+                        raise
+                except BaseException:
+                    # a connection left part way through a request can't
+                    # be used again
+                    self._drop(parts.scheme,parts.netloc)
+                    raise
+            if resp.status in (301,302,303,307,308) and resp.getheader('Location'):
+                try:
+                    resp.read()
+                except BaseException:
+                    self._drop(parts.scheme,parts.netloc)
+                    raise
+                url = urllib.parse.urljoin(url,resp.getheader('Location'))
+                if resp.status == 303:
+                    method = 'GET'
+                continue
+            return resp
+        raise urllib.error.URLError(f"too many redirects for {url}")
+
+    def close(self):
+        """close the connections of every thread"""
+        with self._rate_lock:
+            conns,self._open = self._open,[]
+        for conn in conns:
+            conn.close()
+
+
 class FWTAssetDownloader:
-    def __init__(self,project_dir):
+    """
+    Downloads remote assets referenced by project databases. The
+    download_*_images methods queue downloads along with the database edits
+    to make. Each URL is downloaded once however many documents reference
+    it, and to a target path no other URL uses. process_download_queue downloads on a pool of jobs threads and
+    applies the edits once all of the downloads have finished.
+    """
+    r20_sizes = ('original','max','med')
+    chunk_size = 1024 * 1024
+
+    def __init__(self,project_dir,jobs=1,host_rate=None,probe_cache=None,
+                 download_cache=None):
         self.r20re = re.compile(r'(?P<url>(?P<base>https://s3\.amazonaws\.com/files\.d20\.io/images/(?:[^/]+/)+)(?:\w+)\.(?P<ext>png|jpg|jpeg)[^"]*)')
         self.urlRe = re.compile(r'\w+://[^"]*\.(?P<ext>(png)|(jpg)|(webp))')
         self.project_dir = FWTPath(project_dir)
         self.agent_string = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.87 Safari/537.36'
+        self.jobs = jobs
+        self.http = FWTHttpClient(self.agent_string,host_rate=host_rate)
+        self.download_queue = {}
+        # the URL downloaded to each target path
+        self._targets = {}
+        self.queued_edits = 0
+        self.probe_cache = Path(probe_cache) if probe_cache else None
+        self.download_cache = download_cache
+        self._probes = {}
+        self._probe_lock = threading.Lock()
+        self._probe_pool = None
+        # probes which may have missed a size because a request failed
+        self._unsettled_probes = set()
+        self.load_probe_cache()
+
+    def checkUrl(self,url,log_level=logging.ERROR):
+        try:
+            return self._check_status(url,log_level)
+        except (OSError,http.client.HTTPException) as e:
+            logging.log(log_level,f"URL {url} check failed: {e}")
+            return False
 
-    def checkUrl(self,url):
-        req = urllib.request.Request(
-            url, method='HEAD', headers={'User-Agent':self.agent_string})
-        resp = urllib.request.urlopen(req)
+    def _check_status(self,url,log_level):
+        """HEAD url and return True for HTTP 200. Request errors are raised."""
+        resp = self.http.request('HEAD',url)
+        resp.read()
         if resp.status == 200:
             return True
-        else:
-            logging.error(f"URL {url} returned HTTP Status of {resp.status}")
-            return False
+        logging.log(log_level,f"URL {url} returned HTTP Status of {resp.status}")
+        return False
 
     def downloadUrl(self,u,path):
         url = urllib.parse.urlsplit(u)
@@ -1092,24 +2788,216 @@ class FWTAssetDownloader:
         r20_match = self.r20re.search(url)
         if r20_match:
             url_parts = r20_match.groupdict()
-            for size in ('original','max','med'):
-                check_url = f'{url_parts["base"]}{size}.{url_parts["ext"]}'
-                if self.checkUrl(check_url):
-                    url = check_url
-                    break
+            url = self.probe_r20(url_parts["base"],url_parts["ext"]) or url
 
         logging.debug(f"downloading URL {url}")
-        req = urllib.request.Request(
-            url,method='GET',headers={'User-Agent':self.agent_string})
-        try:
-            resp = urllib.request.urlopen(req)
-        except urllib.error.HTTPError as e:
-            logging.error(f"Download error: {e} for URL {url}")
+        path = Path(path)
+        temp_path = path.with_name(path.name + '.part')
+        # the ETag or Last-Modified of the response being saved to temp_path
+        validator_path = path.with_name(path.name + '.part.validator')
+        headers,digest = {},None
+        if self.download_cache:
+            headers,digest = self.download_cache.lookup(url)
+        offset = temp_path.stat().st_size if temp_path.exists() else 0
+        validator = validator_path.read_text() if validator_path.exists() else None
+        if offset and validator and not digest:
+            # resume a download left by an earlier run if it hasn't changed
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = validator
         else:
+            offset = 0
+        try:
+            resp = self.http.request('GET',url,headers)
+            if resp.status == 304 and digest:
+                resp.read()
+                logging.debug(f"URL {url} not modified, using cached copy")
+                self.download_cache.update(url,digest,
+                    resp.getheader('ETag',headers.get('If-None-Match')),
+                    resp.getheader('Last-Modified',headers.get('If-Modified-Since')))
+                self.download_cache.link(digest,path)
+                return True
+            if resp.status == 206 and not (resp.getheader('Content-Range','')
+                                           .startswith(f'bytes {offset}-')):
+                resp.read()
+                temp_path.unlink()
+                validator_path.unlink(missing_ok=True)
+                logging.error(f"Download error: bad Content-Range for URL {url}")
+                return False
+            if resp.status == 416 and offset:
+                resp.read()
+                temp_path.unlink()
+                validator_path.unlink(missing_ok=True)
+                return self.downloadUrl(u,path)
+            if resp.status not in (200,206):
+                resp.read()
+                logging.error(f"Download error: HTTP Status {resp.status} for URL {url}")
+                return False
             if resp.status == 200:
-                with open(path, "wb") as f:
-                    f.write(resp.read())
+                # a new download, or the file changed since the partial one
+                offset = 0
+                validator = resp.getheader('ETag')
+                if not validator or validator.startswith('W/'):
+                    # weak ETags can't be used with If-Range
+                    validator = resp.getheader('Last-Modified')
+                if validator:
+                    validator_path.write_text(validator)
+                else:
+                    validator_path.unlink(missing_ok=True)
+            length = resp.getheader('Content-Length')
+            expected = offset + int(length) if length else None
+            content_hash = hashlib.sha256()
+            with open(temp_path,'r+b' if offset else 'wb') as f:
+                if offset:
+                    for chunk in iter(lambda: f.read(self.chunk_size),b''):
+                        content_hash.update(chunk)
+                for chunk in iter(lambda: resp.read(self.chunk_size),b''):
+                    f.write(chunk)
+                    content_hash.update(chunk)
+                size = f.tell()
+            if expected is not None and size != expected:
+                logging.error(f"Download error: received {size} of {expected} "
+                              f"bytes for URL {url}")
+                return False
+            if self.download_cache:
+                digest = self.download_cache.store(url,temp_path,
+                    content_hash.hexdigest(),resp.getheader('ETag'),
+                    resp.getheader('Last-Modified'))
+                self.download_cache.link(digest,path)
+            else:
+                temp_path.replace(path)
+            validator_path.unlink(missing_ok=True)
+        except (OSError,http.client.HTTPException) as e:
+            logging.error(f"Download error: {e} for URL {url}")
+            return False
+        return True
 
+    def probe_r20(self,base,ext):
+        """
+        Return the URL of the largest roll20 image size available for base,
+        or None. All of the sizes are checked at the same time. Results are
+        kept for each base URL so actors sharing an image only probe once.
+        """
+        key = f"{base}*.{ext}"
+        with self._probe_lock:
+            probe = self._probes.get(key)
+            owner = probe is None
+            if owner:
+                probe = Future()
+                self._probes[key] = probe
+        if not isinstance(probe,Future):
+            return probe
+        if owner:
+            try:
+                url,settled = self._probe_sizes(base,ext)
+                if not settled:
+                    with self._probe_lock:
+                        self._unsettled_probes.add(key)
+                probe.set_result(url)
+            except Exception as err:
+                probe.set_exception(err)
+        return probe.result()
+
+    def _probe_sizes(self,base,ext):
+        """
+        Return the URL of the largest size found and whether the result is
+        settled, False when the check of a larger size couldn't be made
+        """
+        with self._probe_lock:
+            if not self._probe_pool:
+                self._probe_pool = ThreadPoolExecutor(
+                    max_workers=len(self.r20_sizes) * self.jobs)
+            pool = self._probe_pool
+        urls = [f'{base}{size}.{ext}' for size in self.r20_sizes]
+        # a missing size is expected so failed checks are only debug messages
+        checks = [pool.submit(self._check_status,url,logging.DEBUG)
+                  for url in urls]
+        settled = True
+        for url,check in zip(urls,checks):
+            try:
+                if check.result():
+                    return url,settled
+            except (OSError,http.client.HTTPException) as e:
+                logging.debug(f"URL {url} check failed: {e}")
+                settled = False
+        return None,settled
+
+    def load_probe_cache(self):
+        if self.probe_cache and self.probe_cache.exists():
+            with self.probe_cache.open(encoding='utf-8') as f:
+                self._probes.update(json.load(f))
+
+    def save_probe_cache(self):
+        """save the roll20 sizes found to the probe cache file"""
+        if not self.probe_cache:
+            return
+        probes = {}
+        for key,probe in self._probes.items():
+            if key in self._unsettled_probes:
+                continue
+            if isinstance(probe,Future):
+                probe = probe.result() if probe.done() and not probe.exception() else None
+            if probe:
+                probes[key] = probe
+        self.probe_cache.parent.mkdir(parents=True,exist_ok=True)
+        with FWTFileWriter(self.probe_cache) as f:
+            f.write(json.dumps(probes,indent=4,sort_keys=True))
+
+    def add_download(self,url,target_path,apply):
+        """
+        queue url to be downloaded to target_path. apply is called with the
+        path of the downloaded file relative to the foundry user dir after
+        all queued downloads have finished.
+        """
+        self.queued_edits += 1
+        if url in self.download_queue:
+            self.download_queue[url][1].append(apply)
+            return
+        target_path = self._claim_target(url,target_path)
+        target_path.parent.mkdir(parents=True,exist_ok=True)
+        self.download_queue[url] = (target_path,[apply])
+
+    def _claim_target(self,url,target_path):
+        """
+        return target_path, or a numbered name next to it when another URL
+        is already downloaded there, so no two downloads share a file
+        """
+        path,n = target_path,1
+        while path.as_posix() in self._targets:
+            n += 1
+            path = FWTPath(target_path.parent /
+                f"{target_path.stem}-{n}{target_path.suffix}",exists=False)
+        if n > 1:
+            logging.warning(f"{url} and {self._targets[target_path.as_posix()]}"
+                            f" both download to {target_path}, using {path}")
+        self._targets[path.as_posix()] = url
+        return path
+
+    def process_download_queue(self):
+        """download all queued URLs then apply the database edits"""
+        queue,self.download_queue = self.download_queue,{}
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            jobs = [pool.submit(self.downloadUrl,url,target_path)
+                    for url,(target_path,_) in queue.items()]
+            results = [job.result() for job in jobs]
+        with self._probe_lock:
+            probe_pool,self._probe_pool = self._probe_pool,None
+        if probe_pool:
+            probe_pool.shutdown()
+        self.http.close()
+        self.save_probe_cache()
+        if self.download_cache:
+            self.download_cache.close()
+            self.download_cache = None
+        failed = 0
+        for (url,(target_path,edits)),ok in zip(queue.items(),results):
+            if ok and target_path.exists():
+                logging.debug(f"downloaded {url} to {target_path}")
+                for apply in edits:
+                    apply(target_path.as_rtp())
+            else:
+                failed += 1
+                logging.error(f"Downloaded file {target_path} was not found")
+        return failed
 
     def formatFilename(self,name):
         filename = re.sub(r'[^A-Za-z0-9\-\ \.]','',name)
@@ -1121,6 +3009,7 @@ class FWTAssetDownloader:
         item_name = item["name"]
         item_img = item["img"]
         item_desc = item["data"]["description"]["value"]
+        item_dir = None
         if not item_img:
             logging.error(f"\nNo image set for {item_name}. Skipping \n")
             return False
@@ -1137,13 +3026,7 @@ class FWTAssetDownloader:
             item_dir = Path(asset_dir) / self.formatFilename(item_name)
             filename = self.formatFilename(f"image.{img_match.group('ext')}")
             target_path = FWTPath(self.project_dir / item_dir / filename,exists=False)
-            target_path.parent.mkdir(parents=True,exist_ok=True)
-            self.downloadUrl(item_img,target_path)
-            if target_path.exists():
-                item['img'] = target_path.as_rtp()
-                item_img = item['img']
-            else:
-                raise FileNotFoundError(f"Downloaded file {target_path} was not found")
+            self.add_download(item_img,target_path,set_value(item,'img'))
         if desc_match:
             urls = set()
             if not item_dir:
@@ -1154,15 +3037,8 @@ class FWTAssetDownloader:
                 urls.add(match[0])
                 filename = self.formatFilename(f"{item_name}-desc-{len(urls)}.{match.group('ext')}")
                 target_path = FWTPath(self.project_dir / item_dir / filename,exists=False)
-                target_path.parent.mkdir(parents=True,exist_ok=True)
-                self.downloadUrl(match[0],target_path)
-                if target_path.exists():
-                    logging.debug(f"downloaded {match[0]} to {target_path}")
-                    item_desc = item_desc.replace(
-                        match[0],target_path.as_rtp())
-                else:
-                    raise FileNotFoundError(f"Downloaded file {target_path} was not found")   
-            item["data"]["description"]["value"] = item_desc
+                self.add_download(match[0],target_path,
+                    replace_in_value(item["data"]["description"],'value',match[0]))
 
     def download_actor_images(self,actor,asset_dir='characters'):
         actor_img = actor["img"]
@@ -1195,23 +3071,12 @@ class FWTAssetDownloader:
                 character_dir = Path(asset_dir) / self.formatFilename(actor_name)
             filename = self.formatFilename(f"avatar.{img_match.group('ext')}")
             target_path = FWTPath(self.project_dir / character_dir / filename,exists=False)
-            target_path.parent.mkdir(parents=True,exist_ok=True)
-            self.downloadUrl(actor_img,target_path)
-            if target_path.exists():
-                actor['img'] = target_path.as_rtp()
-                actor_img = actor['img']
-            else:
-                logging.error(f"Downloaded file {target_path} was not found")
+            self.add_download(actor_img,target_path,set_value(actor,'img'))
         
         if token_match:
             filename = self.formatFilename(f"token.{token_match.group('ext')}")
             target_path = FWTPath(self.project_dir / character_dir / filename,exists=False)
-            target_path.parent.mkdir(parents=True,exist_ok=True)
-            self.downloadUrl(token_img,target_path)
-            if target_path.exists():
-                actor["token"]["img"] = target_path.as_rtp()
-            else:
-                raise FileNotFoundError(f"Downloaded file {target_path} was not found")
+            self.add_download(token_img,target_path,set_value(actor["token"],'img'))
 
         if bio_match:
             urls = set()
@@ -1223,12 +3088,80 @@ class FWTAssetDownloader:
                 urls.add(match.group('url'))
                 filename = f"{actor_name}-bio-{len(urls)}.{match.group('ext')}"
                 target_path = FWTPath(self.project_dir / character_dir / filename,exists=False)
-                target_path.parent.mkdir(parents=True,exist_ok=True)
-                self.downloadUrl(match.group('url'),target_path)
-                if target_path.exists():
-                    logging.debug(f"downloaded {match.group('url')} to {target_path}")
-                    actor_bio = actor_bio.replace(
-                        match.group('url'),target_path.as_rtp())
+                self.add_download(match.group('url'),target_path,
+                    replace_in_value(actor['data']['details']['biography'],
+                                     'value',match.group('url')))
+
+    def download_document_images(self,doc,asset_dir):
+        """
+        queue every remote image found in the values of any document, such
+        as a scene, journal entry or roll table. Images are stored in a
+        directory named after the document and its _id, so documents with
+        the same name don't share files, and each file is named after the
+        key that referenced it.
+        """
+        name = f"{doc['name']}-{doc['_id']}" if doc.get("name") else doc["_id"]
+        doc_dir = Path(asset_dir) / self.formatFilename(name)
+        names = set()
+        for obj,key,value in walk_values(doc):
+            if not isinstance(value,str) or "://" not in value:
+                continue
+            if isinstance(key,int):
+                key = "image"
+            for match in self.urlRe.finditer(value):
+                url = match[0]
+                if match.start() == 0 and not re.search(r'[\s<>]',value):
+                    apply = set_value(obj,key)
                 else:
-                    raise FileNotFoundError(f"Downloaded file {target_path} was not found")   
-            actor['data']['details']['biography']['value'] = actor_bio
+                    apply = replace_in_value(obj,key,url)
+                filename = self.formatFilename(f"{key}.{match.group('ext')}")
+                n = 1
+                while filename in names:
+                    n += 1
+                    filename = self.formatFilename(f"{key}-{n}.{match.group('ext')}")
+                names.add(filename)
+                target_path = FWTPath(self.project_dir / doc_dir / filename,exists=False)
+                self.add_download(url,target_path,apply)
+
+    def download_db_images(self,db,asset_dir,doc_type=None):
+        """
+        queue the remote images of every document in db, reading the file
+        one document at a time. doc_type selects the actor or item layout
+        and any other documents are searched with download_document_images.
+        Returns the documents with queued edits by position in the file,
+        for FWTNeDB.replace_documents once the downloads have finished.
+        """
+        download = {
+            'actors': self.download_actor_images,
+            'items': self.download_item_images
+        }.get(doc_type,self.download_document_images)
+        edited = {}
+        for i,doc in enumerate(db.stream()):
+            queued = self.queued_edits
+            download(doc,asset_dir)
+            if self.queued_edits != queued:
+                edited[i] = doc
+        return edited
+
+def walk_values(obj):
+    """
+    yield (container,key,value) for every value in a tree of dicts and
+    lists
+    """
+    items = obj.items() if isinstance(obj,dict) else enumerate(obj)
+    for key,value in items:
+        yield obj,key,value
+        if isinstance(value,(dict,list)):
+            yield from walk_values(value)
+
+def set_value(obj,key):
+    """return a function which sets obj[key]"""
+    def apply(value):
+        obj[key] = value
+    return apply
+
+def replace_in_value(obj,key,old):
+    """return a function which replaces old in the string obj[key]"""
+    def apply(value):
+        obj[key] = obj[key].replace(old,value)
+    return apply
@@ -13,6 +13,9 @@ setup(
         'jsonlines',
         'pyyaml',
     ],
+    extras_require={
+        'fast': ['orjson'],
+    },
     entry_points = {
         'console_scripts': ['fwt=foundryWorldTools.fwtCli:cli'],
     }
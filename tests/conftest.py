@@ -0,0 +1,16 @@
+import json
+import pytest
+from foundryWorldTools import lib
+
+@pytest.fixture
+def world(tmp_path):
+    """a foundry user data dir holding an empty world w1, returns the world dir"""
+    fud = tmp_path / "fvtt"
+    (fud / "Config").mkdir(parents=True)
+    (fud / "Config" / "options.json").write_text(json.dumps({"dataPath":str(fud)}))
+    world = fud / "Data" / "worlds" / "w1"
+    (world / "data").mkdir(parents=True)
+    (world / "world.json").write_text(json.dumps({"name":"w1","title":"W1"}))
+    lib.clear_path_cache()
+    yield world
+    lib.clear_path_cache()
@@ -0,0 +1,34 @@
+import json
+from click.testing import CliRunner
+from foundryWorldTools import lib, fwtCli
+
+def test_dedup_closes_hash_cache_on_error(world,tmp_path,monkeypatch):
+    monkeypatch.setenv("XDG_CONFIG_HOME",str(tmp_path / "config"))
+    monkeypatch.setenv("HOME",str(tmp_path / "home"))
+    closed = []
+    monkeypatch.setattr(lib.FWTHashCache,"close",
+                        lambda self: closed.append(self) or self._db.close())
+    def fail(self):
+        raise RuntimeError("scan failed")
+    monkeypatch.setattr(lib.FWTSetManager,"scan",fail)
+    result = CliRunner().invoke(fwtCli.cli,["--dataDir",str(world.parents[1]),
+        "dedup","--bycontent",str(world)])
+    assert isinstance(result.exception,RuntimeError), result.output
+    assert len(closed) == 1
+
+def test_batch_isolates_failures(world,tmp_path,monkeypatch):
+    monkeypatch.setenv("XDG_CONFIG_HOME",str(tmp_path / "config"))
+    monkeypatch.setenv("HOME",str(tmp_path / "home"))
+    w2 = world.parent / "w2"
+    (w2 / "data").mkdir(parents=True)
+    (w2 / "world.json").write_text(json.dumps({"name":"w2"}))
+    (w2 / "data" / "actors.db").write_text(
+        json.dumps({"_id":"1","img":"worlds/w2/missing.png"}) + "\n")
+    result = CliRunner().invoke(fwtCli.cli,["--dataDir",str(world.parents[1]),
+        "batch","--jobs","2","--command","verify",str(world.parent / "*")])
+    assert result.exit_code == 1, result.output
+    lines = result.output.splitlines()
+    assert lines[0].startswith("worlds/w1: ok")
+    assert any(line.startswith("worlds/w2: failed") for line in lines)
+    assert "    1 references to 1 missing files" in lines
+    assert lines[-2:] == ["2 projects, 1 ok, 1 failed","Failed: worlds/w2"]
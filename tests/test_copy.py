@@ -0,0 +1,35 @@
+import json
+from foundryWorldTools import lib
+
+def no_reflink(src,dst):
+    raise OSError(lib.errno.EOPNOTSUPP,"reflinks are not supported",src)
+
+def test_copy_file_methods(tmp_path,monkeypatch):
+    src = tmp_path / "src.png"
+    src.write_bytes(b"12345")
+    stats = lib.FWTCopyStats()
+    assert lib.copy_file(src,tmp_path / "h.png","hardlink",stats) == "hardlink"
+    assert (tmp_path / "h.png").stat().st_ino == src.stat().st_ino
+    monkeypatch.setattr(lib,"reflink",no_reflink)
+    assert lib.copy_file(src,tmp_path / "a.png","auto",stats) == "hardlink"
+    assert lib.copy_file(src,tmp_path / "r.png","reflink",stats) == "copy"
+    assert (tmp_path / "r.png").stat().st_ino != src.stat().st_ino
+    assert (tmp_path / "r.png").read_bytes() == b"12345"
+    assert (stats.copied_bytes,stats.linked_bytes) == (5,10)
+    assert str(stats) == "copy: 1 files 5 bytes, hardlink: 2 files 10 bytes"
+
+def test_rename_world_keep_src_links_assets_only(world):
+    (world / "img").mkdir()
+    (world / "img" / "a.png").write_bytes(b"image")
+    db_line = json.dumps({"_id":"1","img":"worlds/w1/img/a.png"}) + "\n"
+    (world / "data" / "actors.db").write_text(db_line)
+    manager = lib.FWTFileManager(world)
+    manager.link_mode = "hardlink"
+    manager.rename_world(world.parent / "w2",keep_src=True)
+    w2 = world.parent / "w2"
+    assert (w2 / "img" / "a.png").stat().st_ino == (world / "img" / "a.png").stat().st_ino
+    assert (w2 / "data" / "actors.db").stat().st_ino != (world / "data" / "actors.db").stat().st_ino
+    assert "worlds/w2/img/a.png" in (w2 / "data" / "actors.db").read_text()
+    assert (world / "data" / "actors.db").read_text() == db_line
+    assert json.loads((w2 / "world.json").read_text())["name"] == "w2"
+    assert manager.copy_stats.linked_bytes == 5
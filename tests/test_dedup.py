@@ -0,0 +1,36 @@
+import os
+from foundryWorldTools import lib
+
+def count_hashes(monkeypatch):
+    calls = []
+    for name in ("hash_file","hash_file_ends"):
+        func = getattr(lib,name)
+        def counted(*args,func=func,name=name,**kwargs):
+            calls.append((name,args[0]))
+            return func(*args,**kwargs)
+        monkeypatch.setattr(lib,name,counted)
+    return calls
+
+def scan(world,cache_file):
+    manager = lib.FWTSetManager(world,"bycontent")
+    manager.hash_cache = lib.FWTHashCache(cache_file)
+    manager.scan()
+    manager.hash_cache.close()
+    return manager
+
+def test_warm_scan_uses_hash_cache(world,tmp_path,monkeypatch):
+    big = os.urandom(3 * lib.HASH_BLOCK_SIZE)
+    (world / "a").mkdir()
+    for name in ("a/1.png","a/2.png","3.png"):
+        (world / name).write_bytes(big)
+    (world / "small1.png").write_bytes(b"small")
+    (world / "small2.png").write_bytes(b"small")
+    cache_file = tmp_path / "hashcache.sqlite"
+    calls = count_hashes(monkeypatch)
+    first = scan(world,cache_file)
+    assert sorted(len(s) for s in first.sets.values()) == [2,3]
+    assert calls
+    calls.clear()
+    second = scan(world,cache_file)
+    assert sorted(first.sets) == sorted(second.sets)
+    assert calls == []
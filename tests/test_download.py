@@ -0,0 +1,166 @@
+import json
+from foundryWorldTools import lib
+
+BASE = "https://s3.amazonaws.com/files.d20.io/images/1/"
+
+def downloader(world,tmp_path,monkeypatch,status):
+    def check(self,url,log_level):
+        result = status[url.rsplit("/",1)[1]]
+        if isinstance(result,Exception):
+            raise result
+        return result
+    monkeypatch.setattr(lib.FWTAssetDownloader,"_check_status",check)
+    return lib.FWTAssetDownloader(world,probe_cache=tmp_path / "probes.json")
+
+def test_probe_after_request_error_is_not_cached(world,tmp_path,monkeypatch):
+    d = downloader(world,tmp_path,monkeypatch,{"original.png":TimeoutError(),
+        "max.png":True,"med.png":True})
+    assert d.probe_r20(BASE,"png") == BASE + "max.png"
+    d.save_probe_cache()
+    assert json.loads((tmp_path / "probes.json").read_text()) == {}
+
+def test_probe_is_cached(world,tmp_path,monkeypatch):
+    d = downloader(world,tmp_path,monkeypatch,{"original.png":False,
+        "max.png":True,"med.png":True})
+    assert d.probe_r20(BASE,"png") == BASE + "max.png"
+    d.save_probe_cache()
+    assert json.loads((tmp_path / "probes.json").read_text()) == {
+        f"{BASE}*.png":BASE + "max.png"}
+
+import threading
+import http.server
+import pytest
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    content = b""
+    etag = ""
+    ranges = []
+    bodies = 0
+    def log_message(self,*args):
+        pass
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.send_header("ETag",self.etag)
+            self.end_headers()
+            return
+        RangeHandler.bodies += 1
+        body,start = self.content,0
+        rng = self.headers.get("Range")
+        if rng and self.headers.get("If-Range") == self.etag:
+            start = int(rng.split("=")[1].rstrip("-"))
+            RangeHandler.ranges.append(start)
+            self.send_response(206)
+            self.send_header("Content-Range",
+                             f"bytes {start}-{len(body)-1}/{len(body)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag",self.etag)
+        self.send_header("Content-Length",str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+@pytest.fixture
+def range_server():
+    RangeHandler.ranges = []
+    RangeHandler.bodies = 0
+    srv = http.server.ThreadingHTTPServer(("127.0.0.1",0),RangeHandler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever,daemon=True).start()
+    yield f"http://127.0.0.1:{srv.server_address[1]}/a.png"
+    srv.shutdown()
+    srv.server_close()
+
+def partial(world,content,etag):
+    target = world / "a.png"
+    (world / "a.png.part").write_bytes(content)
+    (world / "a.png.part.validator").write_text(etag)
+    return target
+
+def test_resume_unchanged_download(world,range_server):
+    RangeHandler.content,RangeHandler.etag = b"0123456789",'"v1"'
+    target = partial(world,b"01234",'"v1"')
+    assert lib.FWTAssetDownloader(world).downloadUrl(range_server,target)
+    assert target.read_bytes() == b"0123456789"
+    assert RangeHandler.ranges == [5]
+    assert not (world / "a.png.part.validator").exists()
+
+def test_resume_changed_download_restarts(world,range_server):
+    RangeHandler.content,RangeHandler.etag = b"abcdefghij",'"v2"'
+    target = partial(world,b"01234",'"v1"')
+    assert lib.FWTAssetDownloader(world).downloadUrl(range_server,target)
+    assert target.read_bytes() == b"abcdefghij"
+    assert RangeHandler.ranges == []
+
+def test_download_sweep_streams_documents(world,range_server,monkeypatch):
+    RangeHandler.content,RangeHandler.etag = b"image",'"v1"'
+    db_file = world / "data" / "scenes.db"
+    docs = [{"_id":"a","name":"Map","img":range_server},
+            {"_id":"b","name":"Local","img":"worlds/w1/b.png"}]
+    db_file.write_text("".join(json.dumps(d) + "\n" for d in docs))
+    monkeypatch.setattr(lib.FWTNeDB,"load",
+                        lambda self: pytest.fail("database was loaded"))
+    db = lib.FWTNeDB(db_file)
+    downloader = lib.FWTAssetDownloader(world)
+    edited = downloader.download_db_images(db,lib.Path("assets"),"scenes")
+    assert list(edited) == [0]
+    assert downloader.process_download_queue() == 0
+    db.replace_documents(edited)
+    lines = [json.loads(line) for line in db_file.read_text().splitlines()]
+    assert lines[1] == docs[1]
+    assert lines[0]["img"].startswith("worlds/w1/assets/")
+    assert (world.parents[1] / lines[0]["img"]).read_bytes() == b"image"
+
+def test_urls_with_the_same_target_get_their_own_files(world):
+    downloader = lib.FWTAssetDownloader(world)
+    target = lib.FWTPath(world / "characters" / "bob" / "avatar.png",exists=False)
+    for url in ("http://a/1.png","http://a/2.png","http://a/1.png"):
+        downloader.add_download(url,target,lambda value: None)
+    assert {url:path.name for url,(path,_) in downloader.download_queue.items()} \
+        == {"http://a/1.png":"avatar.png","http://a/2.png":"avatar-2.png"}
+
+def test_failed_rename_is_a_failed_download(world,range_server):
+    RangeHandler.content,RangeHandler.etag = b"image",'"v1"'
+    target = world / "a.png"
+    (target / "in-the-way").mkdir(parents=True)
+    assert lib.FWTAssetDownloader(world).downloadUrl(range_server,target) is False
+
+def test_documents_with_the_same_name_get_their_own_files(world,range_server):
+    RangeHandler.content,RangeHandler.etag = b"image",'"v1"'
+    db_file = world / "data" / "scenes.db"
+    docs = [{"_id":"a","name":"Map","img":range_server},
+            {"_id":"b","name":"Map","img":range_server.replace("a.png","b.png")},
+            {"_id":"c","name":"Map","img":range_server}]
+    db_file.write_text("".join(json.dumps(d) + "\n" for d in docs))
+    db = lib.FWTNeDB(db_file)
+    downloader = lib.FWTAssetDownloader(world,jobs=4)
+    edited = downloader.download_db_images(db,lib.Path("assets"),"scenes")
+    assert downloader.process_download_queue() == 0
+    db.replace_documents(edited)
+    lines = [json.loads(line) for line in db_file.read_text().splitlines()]
+    assert [line["img"] for line in lines] == ["worlds/w1/assets/map-a/img.png",
+        "worlds/w1/assets/map-b/img.png","worlds/w1/assets/map-a/img.png"]
+
+def test_download_cache_stores_content_once(world,range_server,tmp_path):
+    RangeHandler.content,RangeHandler.etag = b"image",'"v1"'
+    urls = [range_server,range_server.replace("a.png","b.png")]
+    targets = [world / "a.png",world / "b.png"]
+    cache = lib.FWTDownloadCache(tmp_path / "downloads")
+    downloader = lib.FWTAssetDownloader(world,download_cache=cache)
+    for url,target in zip(urls,targets):
+        assert downloader.downloadUrl(url,target)
+    cache.close()
+    assert RangeHandler.bodies == 2
+    objects = tmp_path / "downloads" / "objects"
+    assert len([p for p in objects.rglob("*") if p.is_file()]) == 1
+    assert targets[0].stat().st_ino == targets[1].stat().st_ino
+    for target in targets:
+        target.unlink()
+    cache = lib.FWTDownloadCache(tmp_path / "downloads")
+    downloader = lib.FWTAssetDownloader(world,download_cache=cache)
+    for url,target in zip(urls,targets):
+        assert downloader.downloadUrl(url,target)
+    cache.close()
+    assert RangeHandler.bodies == 2
+    assert [t.read_bytes() for t in targets] == [b"image",b"image"]
@@ -0,0 +1,47 @@
+import time
+import threading
+import http.server
+import pytest
+from foundryWorldTools import lib
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    def log_message(self,*args):
+        pass
+    def do_GET(self):
+        if self.path == "/slow":
+            time.sleep(1)
+        body = b"ok"
+        try:
+            self.send_response(200)
+            self.send_header("Content-Length",str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError,ConnectionResetError):
+            pass # the client gave up on the slow response
+
+@pytest.fixture
+def server():
+    srv = http.server.ThreadingHTTPServer(("127.0.0.1",0),Handler)
+    srv.daemon_threads = True
+    thread = threading.Thread(target=srv.serve_forever,daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{srv.server_address[1]}"
+    srv.shutdown()
+    srv.server_close()
+
+def test_connection_usable_after_timeout(server):
+    client = lib.FWTHttpClient("fwt-test",timeout=0.3)
+    with pytest.raises(OSError):
+        client.request("GET",f"{server}/slow")
+    resp = client.request("GET",f"{server}/fast")
+    assert resp.status == 200
+    assert resp.read() == b"ok"
+    client.close()
+
+def test_connection_usable_after_unread_response(server):
+    client = lib.FWTHttpClient("fwt-test")
+    client.request("GET",f"{server}/fast")
+    resp = client.request("GET",f"{server}/fast")
+    assert resp.read() == b"ok"
+    client.close()
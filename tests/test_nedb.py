@@ -0,0 +1,84 @@
+import json
+import pytest
+from foundryWorldTools import lib
+
+def write_db(path,docs):
+    path.write_text("".join(json.dumps(d) + "\n" for d in docs))
+
+def read_db(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+def test_compact_keeps_last_versions_and_indexes(world):
+    db_file = world / "data" / "actors.db"
+    index = {"$$indexCreated":{"fieldName":"name"}}
+    write_db(db_file,[{"_id":"a","v":1},index,{"_id":"b","v":1},
+                      {"_id":"a","v":2},{"_id":"b","$$deleted":True}])
+    before,after = lib.FWTNeDB(db_file).compact()
+    assert after < before
+    assert read_db(db_file) == [{"_id":"a","v":2},index]
+
+def test_compact_all_deleted(world):
+    db_file = world / "data" / "actors.db"
+    write_db(db_file,[{"_id":"a","v":1},{"_id":"a","$$deleted":True}])
+    before,after = lib.FWTNeDB(db_file,trash_dir=world / "trash").compact()
+    assert before > 0 and after == 0
+    assert db_file.read_text() == ""
+    assert read_db(world / "trash" / "data" / "actors.db")[0] == {"_id":"a","v":1}
+
+def stale_db(world,*indexes):
+    db_file = world / "data" / "actors.db"
+    write_db(db_file,[{"_id":"1","img":"a"},{"_id":"1","img":"c"},
+                      {"_id":"2","img":"a"},{"_id":"2","$$deleted":True},
+                      {"$$indexCreated":{"fieldName":"img"}}])
+    db = lib.FWTNeDB(db_file)
+    for field in indexes:
+        db.ensure_index(field)
+    return db
+
+def test_find_sees_only_live_documents(world):
+    for indexes in ((),("img",)):
+        db = stale_db(world,*indexes)
+        assert db.find({"_id":"2"}) == []
+        assert db.find({"img":"a"}) == []
+        assert db.find({"img":"c"}) == [{"_id":"1","img":"c"}]
+        assert db.ids == ("1",)
+
+def test_update_changes_the_live_version(world):
+    for indexes in ((),("img",)):
+        db = stale_db(world,*indexes)
+        assert db.update({"img":"a"},{"$set":{"img":"b"}},{"multi":True}) == 0
+        assert db.update({"img":"c"},{"$set":{"img":"b"}}) == 1
+        assert db.find({"_id":"1"}) == [{"_id":"1","img":"b"}]
+        assert db.find({"img":"b"}) == [{"_id":"1","img":"b"}]
+        assert db["1"] == {"_id":"1","img":"b"}
+        db.insert({"_id":"2","img":"d"})
+        assert db.find({"img":"d"}) == [{"_id":"2","img":"d"}]
+
+def test_compact_keeps_lines_without_id(world):
+    db_file = world / "data" / "actors.db"
+    write_db(db_file,[{"_id":"a","v":1},{"name":"no id"},{"_id":"a","v":2}])
+    lib.FWTNeDB(db_file).compact()
+    assert read_db(db_file) == [{"name":"no id"},{"_id":"a","v":2}]
+
+DOCS = [{"_id":"a","name":"Ünïcode","big":2**70,"n":-12345678901234567890,
+         "f":1.5,"list":[1,{"z":None,"b":True}]},{"_id":"b","v":1}]
+
+def test_nedb_json_with_and_without_orjson(monkeypatch):
+    lines = [json.dumps(d) for d in DOCS]
+    expected = [json.dumps(d,sort_keys=True,separators=(",",":"),ensure_ascii=False)
+                for d in DOCS]
+    for backend in (lib.orjson,None):
+        monkeypatch.setattr(lib,"orjson",backend)
+        assert [lib.nedb_loads(line) for line in lines] == DOCS
+        assert [lib.nedb_dumps(d) for d in DOCS] == expected
+
+def test_transform_streams_documents(world,monkeypatch):
+    db_file = world / "data" / "actors.db"
+    db_file.write_text(json.dumps(DOCS[0]) + "\n\n" + json.dumps(DOCS[1]) + "\n")
+    monkeypatch.setattr(lib.FWTNeDB,"load",lambda self: pytest.fail("database was loaded"))
+    db = lib.FWTNeDB(db_file)
+    assert list(db.stream()) == DOCS
+    def rename(doc):
+        return None if doc["_id"] == "b" else {**doc,"name":"x"}
+    assert db.transform(rename,append=[{"_id":"c"}]) == 2
+    assert read_db(db_file) == [{**DOCS[0],"name":"x"},{"_id":"c"}]
@@ -0,0 +1,56 @@
+import json
+from foundryWorldTools import lib
+
+def count_calls(monkeypatch,name):
+    calls = []
+    func = getattr(lib,name)
+    def counted(d):
+        calls.append(d)
+        return func(d)
+    monkeypatch.setattr(lib,name,counted)
+    return calls
+
+def test_project_lookups_are_cached(world,monkeypatch):
+    (world / "img" / "maps").mkdir(parents=True)
+    for name in ("a.png","b.png"):
+        (world / "img" / "maps" / name).write_bytes(b"x")
+    calls = count_calls(monkeypatch,"_manafest_in_dir")
+    a = lib.FWTPath(world / "img" / "maps" / "a.png")
+    assert (a.project_type,a.project_name) == ("world","w1")
+    assert a.as_rpd() == "worlds/w1"
+    assert a.as_rtp() == "worlds/w1/img/maps/a.png"
+    walked = len(calls)
+    assert walked == 3
+    b = lib.FWTPath(world / "img" / "maps" / "b.png")
+    lib.FWTPath(world / "img" / "c.png",exists=False)
+    assert b.project_name == "w1"
+    assert len(calls) == walked
+
+def test_changed_manifest_is_read_again(world):
+    assert lib.FWTPath(world).project_name == "w1"
+    (world / "world.json").write_text(json.dumps({"name":"w1-renamed"}))
+    assert lib.FWTPath(world).project_name == "w1-renamed"
+
+def test_removed_manifest_clears_the_cache(world):
+    assert lib.FWTPath(world / "world.json").is_project
+    (world / "world.json").unlink()
+    assert not lib.FWTPath(world / "data").is_project
+
+def test_derived_paths_dont_resolve_again(world,monkeypatch):
+    (world / "img").mkdir()
+    (world / "img" / "a.png").write_bytes(b"x")
+    path = lib.FWTPath(world / "img" / "a.png")
+    def fail(*args,**kwargs):
+        raise AssertionError("path resolved again")
+    with monkeypatch.context() as m:
+        m.setattr(lib,"resolve_fvtt_path",fail)
+        m.setattr(lib.os,"stat",fail)
+        fpd,ftp = path.to_fpd(),path.to_ftp()
+        assert fpd == world and ftp == world / "img" / "a.png"
+        assert (fpd.as_rpd(),fpd.as_rtp()) == ("worlds/w1","worlds/w1")
+        assert fpd.is_project_dir() and fpd.project_name == "w1"
+        assert ftp.as_rtp() == "worlds/w1/img/a.png"
+        assert path.as_fpd() == world.as_posix()
+        assert path.as_ftp() == (world / "img" / "a.png").as_posix()
+        assert path.as_rpp() == "img/a.png"
+        assert fpd.manafest == world / "world.json"
@@ -0,0 +1,28 @@
+import json
+from foundryWorldTools import lib
+
+def tree(path):
+    return sorted(p.relative_to(path).as_posix() for p in path.rglob("*"))
+
+def test_plan_leaves_project_unchanged(world,tmp_path):
+    (world / "img").mkdir()
+    (world / "img" / "a.png").write_bytes(b"same")
+    (world / "img" / "b.png").write_bytes(b"same")
+    (world / "data" / "actors.db").write_text(
+        json.dumps({"_id":"1","img":"worlds/w1/img/b.png"}) + "\n")
+    before = tree(world)
+    manager = lib.FWTSetManager(world,"bycontent")
+    manager.add_preferred_pattern(r".*/a\.png")
+    manager.scan()
+    manager.set_preferred_on_all()
+    manager.generate_rewrite_queue()
+    plan_file = tmp_path / "plan.json"
+    plan_file.write_text(json.dumps(manager.plan()))
+    assert tree(world) == before
+    manager = lib.load_plan(plan_file)
+    assert tree(world) == before
+    manager.process_file_queue()
+    manager.process_rewrite_queue()
+    assert not (world / "img" / "b.png").exists()
+    assert (world / "trash" / "session.0" / "img" / "b.png").exists()
+    assert "img/a.png" in (world / "data" / "actors.db").read_text()
@@ -0,0 +1,101 @@
+import json
+from foundryWorldTools import lib
+
+def write_db(path,docs):
+    path.write_text("".join(json.dumps(d) + "\n" for d in docs))
+
+def make_world(world):
+    (world / "img").mkdir()
+    (world / "img" / "a.png").write_bytes(b"a")
+    write_db(world / "data" / "actors.db",[{"_id":"1","img":"/worlds/w1/img/a.png"}])
+    write_db(world / "data" / "scenes.db",[{"_id":"2","img":"worlds/w1/img/a.png?v=2",
+        "description":'<img src="/worlds/w1/img/a.png#top">'}])
+    write_db(world / "data" / "items.db",[{"_id":"3","img":"worlds/w1/img/b.png"}])
+
+def index(world,tmp_path):
+    ref_index = lib.FWTRefIndex(tmp_path / "refindex.sqlite",world)
+    ref_index.refresh()
+    return ref_index
+
+def test_references_are_normalized(world,tmp_path):
+    make_world(world)
+    ref_index = index(world,tmp_path)
+    assert [db.name for db in ref_index.dbs_referencing(["worlds/w1/img/a.png"])] \
+        == ["actors.db","scenes.db"]
+    assert lib.normalize_ref("/worlds/w1/my%20map.png?v=2#x") == "worlds/w1/my map.png"
+
+def test_rename_rewrites_normalized_references(world,tmp_path):
+    make_world(world)
+    manager = lib.FWTFileManager(world)
+    manager.ref_index = index(world,tmp_path)
+    f = manager.add_file(world / "img" / "a.png")
+    f.new_path = world / "img" / "c.png"
+    manager.generate_rewrite_queue()
+    manager.process_file_queue()
+    manager.process_rewrite_queue()
+    assert "img/c.png" in (world / "data" / "actors.db").read_text()
+    scenes = (world / "data" / "scenes.db").read_text()
+    assert "a.png" not in scenes and "c.png?v=2" in scenes
+
+def test_find_remote_assets_without_index(world,tmp_path):
+    fud = world.parents[1]
+    for name in ("m1","m10"):
+        module = fud / "modules" / name
+        module.mkdir(parents=True)
+        (module / "module.json").write_text(json.dumps({"name":name}))
+        (module / "a.png").write_bytes(b"a")
+    write_db(world / "data" / "actors.db",[{"_id":"1","img":"/modules/m1/a.png?v=1",
+        "token":{"img":"modules/m10/a.png"}}])
+    manager = lib.FWTFileManager(world)
+    manager.find_remote_assets(fud / "modules" / "m1")
+    assert [f.path.as_rtp() for f in manager._files] == ["modules/m1/a.png"]
+    manager.ref_index = index(world,tmp_path)
+    manager.find_remote_assets(fud / "modules" / "m1")
+    assert [f.path.as_rtp() for f in manager._files] == ["modules/m1/a.png"]
+
+def test_find_orphans_normalizes_and_checks_raw_text(world,tmp_path):
+    (world / "img").mkdir()
+    for name in ("a.png","b.png","c.png","my map.png"):
+        (world / "img" / name).write_bytes(name.encode())
+    write_db(world / "data" / "actors.db",[{"_id":"1","img":"/worlds/w1/img/a.png?v=2",
+        "token":{"img":"worlds/w1/img/my%20map.png#x"}}])
+    write_db(world / "data" / "journal.db",[{"_id":"2",
+        "content":"note:worlds/w1/img/b.png"}])
+    manager = lib.FWTFileManager(world)
+    manager.ref_index = index(world,tmp_path)
+    manager.add_file_extensions(["png"])
+    manager.scan()
+    assert [f.path.name for f in manager.find_orphans()] == ["c.png"]
+
+def test_missing_normalizes_and_reports_unchecked(world,tmp_path):
+    make_world(world)
+    write_db(world / "data" / "tokens.db",[{"_id":"4","img":"icons/svg/mystery-man.svg",
+        "texture":"/worlds/w1/img/gone.png?v=1"}])
+    ref_index = index(world,tmp_path)
+    missing = [(lib.Path(db).name,*ref) for db,*ref in ref_index.missing()]
+    assert missing == [("items.db","3","img","worlds/w1/img/b.png"),
+                       ("tokens.db","4","texture","worlds/w1/img/gone.png")]
+    assert [asset for *_,asset in ref_index.unchecked()] == ["icons/svg/mystery-man.svg"]
+
+def test_asset_refs_of_text_and_keys():
+    doc = {"a":"See worlds/w1/img/a.png","b":"worlds/w1/b.png, worlds/w1/c.png",
+           "c":"<p>worlds/w1/my map.png</p>","d":"worlds/w1/my dir/d.png",
+           "flags":{"m":{"worlds/w1/e.png":True}}}
+    assert sorted(path for _,path in lib.asset_refs(doc)) == [
+        "worlds/w1/b.png","worlds/w1/c.png","worlds/w1/e.png",
+        "worlds/w1/img/a.png","worlds/w1/my dir/d.png","worlds/w1/my map.png"]
+
+def test_rename_rewrites_references_the_index_missed(world,tmp_path):
+    make_world(world)
+    write_db(world / "data" / "journal.db",[{"_id":"4",
+        "content":"note:worlds/w1/img/a.png"}])
+    manager = lib.FWTFileManager(world)
+    manager.ref_index = index(world,tmp_path)
+    assert not any(db.name == "journal.db"
+                   for db in manager.ref_index.dbs_referencing(["worlds/w1/img/a.png"]))
+    f = manager.add_file(world / "img" / "a.png")
+    f.new_path = world / "img" / "c.png"
+    manager.generate_rewrite_queue()
+    manager.process_file_queue()
+    manager.process_rewrite_queue()
+    assert "note:worlds/w1/img/c.png" in (world / "data" / "journal.db").read_text()
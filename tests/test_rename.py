@@ -0,0 +1,52 @@
+import json
+import pytest
+from foundryWorldTools import lib
+
+def test_load_rename_map(tmp_path):
+    pairs = [("worlds/w1/a.png","worlds/w1/b.png"),("worlds/w1/c.png","worlds/w1/d.png")]
+    (tmp_path / "map.csv").write_text("src,target\n" + "".join(f"{s}, {t}\n" for s,t in pairs))
+    (tmp_path / "map.json").write_text(json.dumps(dict(pairs)))
+    (tmp_path / "map.yaml").write_text("".join(f"- [{s}, {t}]\n" for s,t in pairs))
+    for name in ("map.csv","map.json","map.yaml"):
+        assert lib.load_rename_map(tmp_path / name) == pairs
+    (tmp_path / "map.txt").write_text("")
+    with pytest.raises(lib.FWTFileError):
+        lib.load_rename_map(tmp_path / "map.txt")
+
+def make_files(world,*names):
+    (world / "img").mkdir()
+    for name in names:
+        (world / "img" / name).write_bytes(name.encode())
+
+def test_invalid_rename_map_changes_nothing(world):
+    make_files(world,"a.png","b.png","c.png")
+    manager = lib.FWTFileManager(world)
+    with pytest.raises(lib.FWTFileError) as e:
+        manager.add_rename_map([(world / "img" / "a.png",world / "img" / "b.png"),
+                                (world / "img" / "c.png",world / "img" / "x.png"),
+                                (world / "img" / "c.png",world / "img" / "y.png")])
+    assert "exists" in str(e.value) and "renamed twice" in str(e.value)
+    assert manager._files == []
+    assert sorted(p.name for p in (world / "img").iterdir()) == ["a.png","b.png","c.png"]
+
+def test_rename_map_rewrites_each_database_once(world,monkeypatch):
+    make_files(world,"a.png","b.png")
+    for db in ("actors","scenes"):
+        (world / "data" / f"{db}.db").write_text(json.dumps(
+            {"_id":db,"img":"worlds/w1/img/a.png","token":"worlds/w1/img/b.png"}) + "\n")
+    rewritten = []
+    rewrite_file = lib.rewrite_file
+    def counted(file,*args):
+        rewritten.append(lib.Path(file).name)
+        return rewrite_file(file,*args)
+    monkeypatch.setattr(lib,"rewrite_file",counted)
+    manager = lib.FWTFileManager(world)
+    manager.add_rename_map([(world / "img" / "a.png",world / "maps" / "a.png"),
+                            (world / "img" / "b.png",world / "maps" / "b.png")])
+    manager.generate_rewrite_queue()
+    manager.process_file_queue()
+    manager.process_rewrite_queue()
+    assert sorted(rewritten) == ["actors.db","scenes.db","world.json"]
+    assert json.loads((world / "data" / "actors.db").read_text()) == {
+        "_id":"actors","img":"worlds/w1/maps/a.png","token":"worlds/w1/maps/b.png"}
+    assert sorted(p.name for p in (world / "maps").iterdir()) == ["a.png","b.png"]
@@ -0,0 +1,101 @@
+import re
+import random
+import pytest
+from foundryWorldTools import lib
+
+def naive(batch,line,quote_find=False):
+    """the rewrite loop FWTRewriter replaces, one entry at a time"""
+    for find,replace in batch.items():
+        if type(find) == str:
+            if quote_find:
+                find,replace = f'"{find}"',f'"{replace}"'
+            line = line.replace(find,replace)
+        else:
+            line = find.sub(replace,line)
+    return line
+
+LINES = [
+    '{"img":"worlds/w1/a.png","token":{"img":"worlds/w1/ab.png"}}\n',
+    '{"notes":"<img src=\\"worlds/w1/a.png\\"> worlds/w1/a.pngx abab aaa"}\n',
+    '{"name":"world","path":"worlds/w1","b":"bc","c":"cab"}\n',
+    '\n',
+]
+
+BATCHES = [
+    # independent keys
+    {"worlds/w1/a.png":"worlds/w1/b.png","worlds/w1/ab.png":"worlds/w1/c.png"},
+    # a key which is a prefix of another key
+    {"worlds/w1/a.png":"worlds/w1/x.png","worlds/w1/a.pngx":"worlds/w1/y.png"},
+    # keys which overlap in the text
+    {"ab":"1","ba":"2","aa":"3"},
+    # a replacement which forms a later key
+    {"a":"b","b":"c","bc":"d"},
+    # a replacement which contains its own key
+    {"a":"aa","aa":"a"},
+    # regex entries between str entries, as rename_world builds
+    {"worlds/w1":"worlds/w2",re.compile(r'"name":"world"'):'"name":"w2"',
+     "w2/a.png":"w2/z.png",re.compile(r"a+"):"A"},
+]
+
+def test_rewriter_matches_naive_loop():
+    for batch in BATCHES:
+        for quote_find in (False,True):
+            rewrite = lib.FWTRewriter(batch,quote_find)
+            for line in LINES:
+                assert rewrite(line) == naive(batch,line,quote_find), (batch,line)
+
+def test_rewriter_matches_naive_loop_random():
+    rng = random.Random(1)
+    words = lambda n: "".join(rng.choice("abc/") for _ in range(n))
+    for _ in range(500):
+        batch = {words(rng.randint(1,4)):words(rng.randint(0,4))
+                 for _ in range(rng.randint(1,6))}
+        line = words(40)
+        quote_find = rng.random() < 0.2
+        if quote_find:
+            line = '"' + '","'.join(line.split("/")) + '"'
+        assert lib.FWTRewriter(batch,quote_find)(line) \
+            == naive(batch,line,quote_find), (batch,line)
+
+def test_search_file(tmp_path):
+    db = tmp_path / "a.db"
+    db.write_text(LINES[0])
+    assert lib.FWTRewriter({"worlds/w1/ab.png":"x"}).search_file(db)
+    assert not lib.FWTRewriter({"worlds/w2/a.png":"x"}).search_file(db)
+    assert lib.FWTRewriter({re.compile("nothing"):"x"}).search_file(db)
+    (tmp_path / "empty.db").write_text("")
+    assert not lib.FWTRewriter({"a":"b"}).search_file(tmp_path / "empty.db")
+
+def test_rewrite_file_skips_untouched_files(tmp_path):
+    db = tmp_path / "data" / "a.db"
+    db.parent.mkdir()
+    db.write_text(LINES[0])
+    st = db.stat()
+    trash = tmp_path / "trash"
+    assert not lib.rewrite_file(db,lib.FWTRewriter({"worlds/w2":"worlds/w3"}),trash)
+    assert db.stat().st_mtime_ns == st.st_mtime_ns and db.stat().st_ino == st.st_ino
+    assert sorted(p.name for p in tmp_path.rglob("*")) == ["a.db","data"]
+    assert lib.rewrite_file(db,lib.FWTRewriter({"worlds/w1":"worlds/w3"}),trash)
+    assert "worlds/w3/a.png" in db.read_text()
+    assert (trash / "data" / "a.db").read_text() == LINES[0]
+
+def test_files_replace_with_jobs(world):
+    dbs = []
+    for i in range(4):
+        db = world / "packs" / f"p{i}.db"
+        db.parent.mkdir(exist_ok=True)
+        db.write_text(LINES[0] * (i + 1))
+        dbs.append(db)
+    for name in ("bad1.db","bad2.db"):
+        (world / "packs" / name).write_bytes(b'{"img":"worlds/w1/a.png \xff"}\n')
+    manager = lib.FWTFileManager(world)
+    manager.jobs = 3
+    batch = {"worlds/w1/a.png":"worlds/w1/b.png"}
+    with pytest.raises(lib.FWTFileError) as e:
+        manager.files_replace(dbs + [world / "packs" / "bad1.db",
+                                     world / "packs" / "bad2.db"],batch)
+    assert "2 database rewrites failed" in str(e.value)
+    for i,db in enumerate(dbs):
+        assert db.read_text() == naive(batch,LINES[0]) * (i + 1)
+        assert (manager.trash_dir / "packs" / db.name).read_text() == LINES[0] * (i + 1)
+    assert (world / "packs" / "bad1.db").read_bytes().endswith(b'\xff"}\n')
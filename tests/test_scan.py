@@ -0,0 +1,36 @@
+import json
+import re
+from pathlib import PurePosixPath
+from foundryWorldTools import lib
+
+def test_glob_to_regex_matches_like_pathlib():
+    paths = ["/d/worlds/w1/img/cache","/d/worlds/w1/cache/img","/d/worlds/w1/trash",
+             "/d/worlds/w1/trash/session.0","/d/worlds/w1/Data","/d/worlds/w1/a1"]
+    patterns = ["cache","img/cache","*/cache","trash*","/d/worlds/w1/trash","a?","[ab]1",
+                "[!b]1","w1/*"]
+    for pattern in patterns:
+        regex = re.compile(lib.glob_to_regex(pattern))
+        for path in paths:
+            assert bool(regex.search(path)) == PurePosixPath(path).match(pattern), \
+                (pattern,path)
+
+def test_scan_filters_and_prunes(world,monkeypatch):
+    for name in ("img/A.PNG","img/b.txt","img/cache/c.png","trash/session.0/d.png",
+                 "data/e.png","m/module.json","m/f.png"):
+        (world / name).parent.mkdir(parents=True,exist_ok=True)
+        (world / name).write_text("x")
+    (world / "m" / "module.json").write_text(json.dumps({"name":"m"}))
+    scanned = []
+    scandir = lib.os.scandir
+    def counted(path):
+        if lib.Path(path).is_relative_to(world):
+            scanned.append(lib.Path(path).relative_to(world).as_posix())
+        return scandir(path)
+    manager = lib.FWTFileManager(world)
+    manager.add_file_extensions(["png"])
+    manager.add_exclude_dir("cache")
+    monkeypatch.setattr(lib.os,"scandir",counted)
+    manager.scan()
+    assert set(scanned) == {".","img","m"}
+    files = {f.path.as_rtp():f.path.as_rpd() for f in manager._files}
+    assert files == {"worlds/w1/img/A.PNG":"worlds/w1","worlds/w1/m/f.png":"worlds/w1/m"}
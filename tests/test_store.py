@@ -0,0 +1,48 @@
+import json
+from foundryWorldTools import lib
+
+def make_worlds(world):
+    w2 = world.parent / "w2"
+    (w2 / "data").mkdir(parents=True)
+    (w2 / "world.json").write_text(json.dumps({"name":"w2"}))
+    for w in (world,w2):
+        (w / "img").mkdir()
+        (w / "img" / "shared.png").write_bytes(b"shared content")
+        (w / "data" / "actors.db").write_text(json.dumps(
+            {"_id":"1","img":f"{w.relative_to(world.parents[1]).as_posix()}/img/shared.png"}) + "\n")
+    (world / "img" / "own.png").write_bytes(b"only in w1")
+    (world / "img" / "own2.png").write_bytes(b"only in w1")
+    return w2
+
+def dedup(world,w2,hardlink=False):
+    manager = lib.FWTStoreManager([world,w2])
+    manager.hardlink = hardlink
+    manager.add_file_extensions(["png"])
+    manager.scan()
+    manager.set_preferred_on_all()
+    manager.generate_rewrite_queue()
+    manager.process_file_queue()
+    manager.process_rewrite_queue()
+    return manager
+
+def test_shared_files_move_to_the_store(world):
+    w2 = make_worlds(world)
+    manager = dedup(world,w2)
+    assert len(manager.sets) == 1
+    stored = list((world.parents[1] / "fwt-store").rglob("*.png"))
+    assert len(stored) == 1 and stored[0].read_bytes() == b"shared content"
+    store_rtp = stored[0].relative_to(world.parents[1]).as_posix()
+    for w in (world,w2):
+        assert json.loads((w / "data" / "actors.db").read_text())["img"] == store_rtp
+        assert not (w / "img" / "shared.png").exists()
+    assert (world / "img" / "own.png").exists() and (world / "img" / "own2.png").exists()
+    assert manager.reclaimed == len(b"shared content")
+
+def test_shared_files_are_hard_linked(world):
+    w2 = make_worlds(world)
+    before = [(w / "data" / "actors.db").read_text() for w in (world,w2)]
+    manager = dedup(world,w2,hardlink=True)
+    assert (world / "img" / "shared.png").stat().st_ino == (w2 / "img" / "shared.png").stat().st_ino
+    assert [(w / "data" / "actors.db").read_text() for w in (world,w2)] == before
+    assert manager.reclaimed == len(b"shared content")
+    assert len(dedup(world,w2,hardlink=True).sets) == 0